@@ -1,13 +1,41 @@
 from LNdigitalIO import (
     IODIR_ON,
     IODIR_OFF,
+    IODIR_BOTH,
 )
+from .core import DROP_OLDEST, BLOCK
 
 # classes
 from .core import (
     LNdigitals,
+    RemoteLNdigitals,
     InputEventListener,
+    InterruptEvent,
+    OutputChange,
+    OutputSubscription,
 )
+from .stimulus import StimulusScheduler
+
+# functions
+from .core import (
+    attach_emulator,
+    wait_for_input,
+    wait_for_edge,
+    sleep,
+)
+from .record import replay
+from .server import serve
+
+
+
+def __getattr__(name):
+    # only programs that use asyncio pay for importing it
+    if name == 'AsyncLNdigitals':
+        from .aio import AsyncLNdigitals
+        return AsyncLNdigitals
+    raise AttributeError(
+        "module %r has no attribute %r" % (__name__, name))
+
 
 if __name__ == '__main__':
     init()
@@ -0,0 +1,285 @@
+"""asyncio version of LNdigitals.
+
+The connections to the emulator are asyncio streams, so any number of boards
+can be driven from one event loop without a thread per call.
+
+>>> LNd = await AsyncLNdigitals.open(hardware_addr=0)
+>>> await LNd.write(0xaa, OUTPUT_PORT)
+>>> async for event in LNd.events():
+...     print(event.pin_num, event.direction)
+"""
+import asyncio
+import os
+import socket
+import struct
+from multiprocessing.connection import Client
+from .core import (
+    INPUT_PORT,
+    OUTPUT_PORT,
+    EmulatorAddressError,
+    InterruptEvent,
+    LNdigitals,
+    _LNdigitalsDict,
+)
+from .connection import LocalEmulator
+from .pinstate import input_state_offset
+from .protocol import (
+    decode_event,
+    decode_reply,
+    encode_request,
+    request_ids,
+)
+
+
+async def _read_bytes(reader):
+    """Reads a message sent with a multiprocessing connection's
+    send_bytes().
+    """
+    size, = struct.unpack("!i", await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack("!Q", await reader.readexactly(8))
+    return await reader.readexactly(size)
+
+
+def _write_bytes(writer, data):
+    """Writes a message for a multiprocessing connection's recv_bytes()."""
+    writer.write(struct.pack("!i", len(data)) + data)
+
+
+async def _open_stream(emulator):
+    """Connects to the emulator and returns an asyncio (reader, writer)."""
+    loop = asyncio.get_running_loop()
+    # connecting includes the authkey handshake, which blocks
+    connection = await loop.run_in_executor(
+        None, lambda: Client(emulator.address, authkey=emulator.authkey))
+    sock = socket.socket(fileno=os.dup(connection.fileno()))
+    connection.close()
+    if sock.family == socket.AF_UNIX:
+        return await asyncio.open_unix_connection(sock=sock)
+    else:
+        return await asyncio.open_connection(sock=sock)
+
+
+class _AsyncLocalConnection(object):
+    """Sends requests to a LocalEmulator."""
+    def __init__(self, emulator):
+        self.engine = emulator.engine
+
+    async def send(self, action):
+        self.engine.handle(action)
+
+    async def request(self, action):
+        return self.engine.handle(action)
+
+    async def events(self):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        # engine callbacks are called from whichever thread changed the input
+        def put_event(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        self.engine.event_callbacks.append(put_event)
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            self.engine.event_callbacks.remove(put_event)
+
+    async def close(self):
+        pass
+
+
+class _AsyncEmulatorConnection(object):
+    """Sends requests to an emulator in another process, like
+    connection.EmulatorConnection but with replies read by a task.
+    """
+    def __init__(self, emulator, reader, writer):
+        self.emulator = emulator
+        self.reader = reader
+        self.writer = writer
+        self.request_ids = request_ids()
+        # request_id: asyncio.Future
+        self.pending = dict()
+        self.reply_reader = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, emulator):
+        reader, writer = await _open_stream(emulator)
+        return cls(emulator, reader, writer)
+
+    async def send(self, action):
+        _write_bytes(self.writer, encode_request(None, action))
+        await self.writer.drain()
+
+    async def request(self, action):
+        request_id = next(self.request_ids)
+        data = encode_request(request_id, action)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            _write_bytes(self.writer, data)
+            await self.writer.drain()
+        except BaseException:
+            self.pending.pop(request_id, None)
+            raise
+        return await future
+
+    async def read_replies(self):
+        try:
+            while True:
+                request_id, result = decode_reply(
+                    await _read_bytes(self.reader))
+                future = self.pending.pop(request_id)
+                if not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        # the emulator has gone, nothing else is coming
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(
+                    "Lost the connection to the emulator."))
+        self.pending.clear()
+
+    async def events(self):
+        reader, writer = await _open_stream(self.emulator)
+        try:
+            _write_bytes(writer, encode_request(None, ('events',)))
+            await _read_bytes(reader)  # wait until we're subscribed
+            while True:
+                yield decode_event(await _read_bytes(reader))
+        finally:
+            writer.close()
+
+    async def close(self):
+        self.reply_reader.cancel()
+        self.writer.close()
+
+
+class AsyncLNdigitals(object):
+    """An emulated LN Digital for asyncio programs. Use open() to create
+    one. The methods are the same as LNdigitals' but are coroutines, and
+    hardware_addr defaults to this board's.
+    """
+    def __init__(self, hardware_addr, emulator, connection):
+        self.hardware_addr = hardware_addr
+        self.emulator = emulator
+        self.emulator_connection = connection
+        self.pin_state_buf = emulator.pin_state_buf
+
+    @classmethod
+    async def open(cls, hardware_addr=0, emulator=None):
+        """Connects to emulator, which defaults to the emulator shared by
+        the LNdigitals in this process (starting one if there isn't one).
+        """
+        if emulator is None:
+            emulator = _LNdigitalsDict.emulator
+        if emulator is None:
+            loop = asyncio.get_running_loop()
+            emulator = await loop.run_in_executor(
+                None, lambda: LNdigitals(hardware_addr).emulator)
+
+        if isinstance(emulator, LocalEmulator):
+            connection = _AsyncLocalConnection(emulator)
+        else:
+            connection = await _AsyncEmulatorConnection.open(emulator)
+        return cls(hardware_addr, emulator, connection)
+
+    async def close(self):
+        await self.emulator_connection.close()
+
+    async def read_bit(self, bit_num, address, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        if address is INPUT_PORT:
+            if self.pin_state_buf is None:
+                # the emulator is on another machine
+                return await self.emulator_connection.request(
+                    ('get_in', bit_num, hardware_addr))
+            return (self.pin_state_buf[input_state_offset(hardware_addr)]
+                    >> bit_num) & 1
+        elif address is OUTPUT_PORT:
+            return await self.emulator_connection.request(
+                ('get_out', bit_num, hardware_addr))
+        else:
+            raise EmulatorAddressError(
+                "Reading to 0x%X is not supported in the "
+                "LN Digital emulator" % address)
+
+    async def write_bit(self, value, bit_num, address, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        if address is OUTPUT_PORT:
+            await self.emulator_connection.send(
+                ('set_out', bit_num, True if value else False, hardware_addr))
+        else:
+            raise EmulatorAddressError(
+                "Writing to 0x%X is not supported in the LN Digital "
+                "emulator" % address)
+
+    async def read(self, address, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        if address is INPUT_PORT:
+            if self.pin_state_buf is None:
+                return await self.emulator_connection.request(
+                    ('get_port', address, hardware_addr))
+            return self.pin_state_buf[input_state_offset(hardware_addr)]
+        elif address is OUTPUT_PORT:
+            return await self.emulator_connection.request(
+                ('get_port', address, hardware_addr))
+        else:
+            raise EmulatorAddressError(
+                "Reading from 0x%X is not supported in the LN Digital "
+                "emulator" % address)
+
+    async def write(self, data, address, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        if address is OUTPUT_PORT:
+            await self.emulator_connection.send(
+                ('set_port', address, data & 0xff, hardware_addr))
+        else:
+            raise EmulatorAddressError(
+                "Writing to 0x%X is not supported in the LN Digital "
+                "emulator" % address)
+
+    async def write_masked(self, value, mask, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        await self.emulator_connection.send(
+            ('set_masked', mask & 0xff, value & mask & 0xff, hardware_addr))
+
+    async def set_bits(self, mask, hardware_addr=None):
+        await self.write_masked(0xff, mask, hardware_addr)
+
+    async def clear_bits(self, mask, hardware_addr=None):
+        await self.write_masked(0x00, mask, hardware_addr)
+
+    async def toggle_bits(self, mask, hardware_addr=None):
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        await self.emulator_connection.send(
+            ('toggle_masked', mask & 0xff, hardware_addr))
+
+    async def flush(self):
+        """Waits until the emulator has applied every write made so far."""
+        await self.emulator_connection.request(('sync',))
+
+    async def stats(self):
+        """Returns the emulator's statistics, see LNdigitals.stats."""
+        return {'emulator': await self.emulator_connection.request(
+            ('stats',))}
+
+    async def events(self):
+        """Yields an InterruptEvent each time an input on this board
+        changes.
+        """
+        async for event in self.emulator_connection.events():
+            hardware_addr, flag, capture, timestamp = event
+            if hardware_addr == self.hardware_addr:
+                yield InterruptEvent(flag, capture, self, timestamp)
@@ -0,0 +1,159 @@
+"""Measures how fast LNdigitals talks to the emulator.
+
+    python -m LN_Digital_Emulator.bench [--gui] [--threads 4] [--ops 2000]
+                                        [--output results.json]
+
+Every operation is timed against the headless emulator (and the GUI
+emulator with --gui), from one client thread and from --threads, on one
+board and spread over all four. The results are written as JSON with the
+latency percentiles in microseconds and the operations per second. Writes
+don't wait for the emulator, so each thread flushes at the end and that is
+counted in the operations per second.
+"""
+import argparse
+import json
+import sys
+import threading
+from time import perf_counter
+import LNdigitalIO
+from .connection import LocalEmulator, RemoteEmulator
+from .core import (
+    INPUT_PORT,
+    OUTPUT_PORT,
+    LNdigitals,
+    digital_read,
+    digital_write,
+)
+from .pinstate import NUM_LN_DIGITALS
+
+
+OPERATIONS = {
+    'read_bit_input':
+        lambda LNd: LNd.read_bit(0, INPUT_PORT, LNd.hardware_addr),
+    'read_bit_output':
+        lambda LNd: LNd.read_bit(0, OUTPUT_PORT, LNd.hardware_addr),
+    'read_input': lambda LNd: LNd.read(INPUT_PORT, LNd.hardware_addr),
+    'read_output': lambda LNd: LNd.read(OUTPUT_PORT, LNd.hardware_addr),
+    'write_bit':
+        lambda LNd: LNd.write_bit(1, 0, OUTPUT_PORT, LNd.hardware_addr),
+    'write': lambda LNd: LNd.write(0xaa, OUTPUT_PORT, LNd.hardware_addr),
+    'digital_read': lambda LNd: digital_read(0, LNd.hardware_addr),
+    'digital_write': lambda LNd: digital_write(0, 1, LNd.hardware_addr),
+}
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def start_emulator(gui):
+    if gui:
+        return RemoteEmulator.start([sys.argv[0]],
+                                    False,
+                                    0,
+                                    LNdigitalIO.DEFAULT_SPI_BUS,
+                                    LNdigitalIO.DEFAULT_SPI_CHIP_SELECT,
+                                    60)
+    else:
+        return LocalEmulator()
+
+
+def stop_emulator(emulator):
+    if isinstance(emulator, RemoteEmulator):
+        emulator.connection.send(('quit',))
+        emulator.process.join(5)
+
+
+def time_operation(operation, boards, num_threads, num_ops):
+    """Runs operation num_ops times in each of num_threads threads, which
+    take turns with boards. Returns (latencies, elapsed seconds).
+    """
+    start_line = threading.Barrier(num_threads + 1)
+    latencies = list()
+    latencies_lock = threading.Lock()
+
+    def client(LNd):
+        times = list()
+        start_line.wait()
+        for i in range(num_ops):
+            start = perf_counter()
+            operation(LNd)
+            times.append(perf_counter() - start)
+        LNd.flush()
+        with latencies_lock:
+            latencies.extend(times)
+
+    threads = [threading.Thread(target=client,
+                                args=(boards[i % len(boards)],))
+               for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    start_line.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    return latencies, perf_counter() - start
+
+
+def summarise(latencies, elapsed):
+    latencies.sort()
+    percentiles = dict()
+    for percentile in PERCENTILES:
+        index = min(len(latencies) - 1,
+                    int(len(latencies) * percentile / 100))
+        percentiles['p%g' % percentile] = latencies[index] * 1e6
+    percentiles['max'] = latencies[-1] * 1e6
+    return {'ops': len(latencies),
+            'ops_per_sec': len(latencies) / elapsed,
+            'latency_us': percentiles}
+
+
+def run(gui=False, num_threads=4, num_ops=2000):
+    """Runs the benchmarks, returns the results as a list of dicts."""
+    results = list()
+    emulator_kinds = ['headless', 'gui'] if gui else ['headless']
+    for emulator_kind in emulator_kinds:
+        emulator = start_emulator(emulator_kind == 'gui')
+        try:
+            boards = [LNdigitals(hardware_addr,
+                                 emulator=emulator,
+                                 probe_hardware=False)
+                      for hardware_addr in range(NUM_LN_DIGITALS)]
+            for name, operation in sorted(OPERATIONS.items()):
+                for threads in sorted({1, num_threads}):
+                    for num_boards in (1, NUM_LN_DIGITALS):
+                        result = {'emulator': emulator_kind,
+                                  'operation': name,
+                                  'threads': threads,
+                                  'boards': num_boards}
+                        result.update(summarise(*time_operation(
+                            operation, boards[:num_boards], threads,
+                            num_ops)))
+                        results.append(result)
+        finally:
+            stop_emulator(emulator)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m LN_Digital_Emulator.bench",
+        description="Measures the emulator's latency and throughput.")
+    parser.add_argument("--gui", action="store_true",
+                        help="benchmark the GUI emulator too")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of client threads to compare with one")
+    parser.add_argument("--ops", type=int, default=2000,
+                        help="operations per thread for each benchmark")
+    parser.add_argument("--output", help="file to write the JSON to")
+    args = parser.parse_args(argv)
+
+    report = {'python': sys.version,
+              'results': run(args.gui, args.threads, args.ops)}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
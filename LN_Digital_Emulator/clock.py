@@ -0,0 +1,76 @@
+"""The emulator's idea of time: real time, or virtual time that only moves
+when the program sleeps, so timed sequences run as fast as they can be
+computed.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+class RealClock(object):
+    virtual = False
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+REAL_CLOCK = RealClock()
+
+
+class VirtualClock(object):
+    """Simulated time. It stands still until sleep() or advance(), which
+    jump straight to the end, calling the functions scheduled with call_at()
+    at their times on the way.
+
+    monotonic() starts at start, time() is that plus epoch (by default
+    chosen so that time() starts at the real time).
+    """
+    virtual = True
+
+    def __init__(self, start=0.0, epoch=None):
+        self.now = start
+        self.epoch = time.time() - start if epoch is None else epoch
+        # heap of (when, order, callback)
+        self.timers = list()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance_to(self.now + seconds)
+
+    def advance_to(self, when):
+        while self.run_next_timer(when):
+            pass
+        with self.lock:
+            self.now = max(self.now, when)
+
+    def call_at(self, when, callback):
+        """Calls callback when monotonic() reaches when."""
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.order), callback))
+
+    def run_next_timer(self, deadline=None):
+        """Jumps to the next timer, if it is due by deadline, and calls it.
+        Returns False if there wasn't one.
+        """
+        with self.lock:
+            if not self.timers or (deadline is not None and
+                                   self.timers[0][0] > deadline):
+                return False
+            when, order, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+        callback()
+        return True
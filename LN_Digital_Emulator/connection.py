@@ -0,0 +1,329 @@
+"""How LNdigitals reaches the emulator: either an EmulatorEngine in this
+process or an emulator process serving it with an EmulatorServer.
+"""
+import atexit
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from multiprocessing import Pipe, Process, current_process
+from multiprocessing.connection import Client
+from .clock import REAL_CLOCK
+from .engine import EmulatorEngine, EventQueue
+from .pinstate import PIN_STATE_SIZE, attach_pin_state
+from .record import Recorder
+from .stats import Stats
+from .protocol import (
+    decode_event,
+    decode_output_event,
+    decode_reply,
+    encode_request,
+    request_ids,
+)
+
+
+class LocalConnection(object):
+    """Sends requests to an emulator engine in this process."""
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.stats = Stats()
+
+    def send(self, action):
+        self.emulator.handle(action)
+
+    def request(self, action):
+        start = time.perf_counter()
+        result = self.emulator.handle(action)
+        self.stats.add_time(action[0], time.perf_counter() - start)
+        return result
+
+
+class EmulatorConnection(object):
+    """Sends requests to an emulator in another process.
+
+    Requests are ``(task, *args)`` sent with a request_id, which is None if
+    no reply is wanted (see protocol). Replies come with the request_id of
+    the request they answer and a reader
+    thread hands each one to the Future of the request it answers, so any
+    number of threads can have requests waiting at once.
+
+    stats has the round trip time of each kind of request.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.request_ids = request_ids()
+        # request_id: Future
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        self.stats = Stats()
+        self.stats.gauges['pending_requests'] = lambda: len(self.pending)
+        _start_thread(self.read_replies)
+
+    def send(self, action):
+        with self.send_lock:
+            self.connection.send_bytes(encode_request(None, action))
+
+    def request_future(self, action):
+        """Sends a request, returns a Future for the reply."""
+        future = Future()
+        with self.pending_lock:
+            request_id = next(self.request_ids)
+            # raises before the future is waiting if action doesn't fit
+            data = encode_request(request_id, action)
+            self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.connection.send_bytes(data)
+        except BaseException:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise
+        return future
+
+    def request(self, action):
+        start = time.perf_counter()
+        result = self.request_future(action).result()
+        self.stats.add_time(action[0], time.perf_counter() - start)
+        return result
+
+    def read_replies(self):
+        while True:
+            try:
+                request_id, result = decode_reply(self.connection.recv_bytes())
+            except (EOFError, OSError):
+                break
+            with self.pending_lock:
+                future = self.pending.pop(request_id)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        # the emulator has gone, nothing else is coming
+        with self.pending_lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(
+                ConnectionError("Lost the connection to the emulator."))
+
+
+class LocalEmulator(object):
+    """An emulator with no GUI, running in this process. If record is a
+    file name the emulator's traffic is recorded to it. clock defaults to
+    real time.
+    """
+    # events waiting for a subscriber's callback before the oldest are
+    # dropped
+    max_queued_events = 1024
+
+    def __init__(self, LNdigital=None, record=None, clock=None):
+        self.clock = REAL_CLOCK if clock is None else clock
+        self.pin_state_buf = bytearray(PIN_STATE_SIZE)
+        self.engine = EmulatorEngine(
+            LNdigital, self.pin_state_buf, self.clock)
+        self.connection = LocalConnection(self.engine)
+        if record is not None:
+            atexit.register(Recorder.open(self.engine, record).close)
+
+    def __getstate__(self):
+        raise TypeError("A headless emulator can't be shared with other "
+                        "processes, use the GUI emulator or an emulator "
+                        "server.")
+
+    def subscribe_events(self, callback):
+        """Calls callback with each input event, from its own thread. In
+        virtual time it is called straight away instead, so that events
+        have been handled by the time the clock moves on. Returns a
+        function that unsubscribes.
+        """
+        return self._subscribe(self.engine.event_callbacks, callback)
+
+    def subscribe_output_events(self, callback):
+        """Calls callback with each output event, like subscribe_events."""
+        return self._subscribe(self.engine.output_event_callbacks, callback)
+
+    def _subscribe(self, callbacks, callback):
+        if self.clock.virtual:
+            callbacks.append(callback)
+            return lambda: callbacks.remove(callback)
+        events = EventQueue(self.max_queued_events, self.engine.stats)
+        callbacks.append(events.put)
+        _start_thread(_call_with_each, callback, events.get)
+
+        def unsubscribe():
+            callbacks.remove(events.put)
+            events.put(None)  # stops the thread
+        return unsubscribe
+
+
+class RemoteEmulator(object):
+    """An emulator running in another process, possibly on another
+    machine.
+
+    Every LNdigitals in this process shares one connection to it. It can be
+    pickled and sent to other processes, which then connect to the same
+    emulator. pin_state_buf is None if the emulator's shared pin state
+    can't be reached from here, because it is on another machine.
+    """
+    clock = REAL_CLOCK
+
+    def __init__(self,
+                 address,
+                 authkey,
+                 pin_state_name,
+                 process=None,
+                 connection=None):
+        self.address = address
+        self.authkey = authkey
+        self.pin_state_name = pin_state_name
+        self.process = process
+        self._connection = connection
+        self._pin_state = None
+        self._pin_state_missing = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'address': self.address,
+                'authkey': self.authkey,
+                'pin_state_name': self.pin_state_name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def start(cls,
+              sysargv,
+              use_LNdigital,
+              hardware_addr,
+              bus,
+              chip_select,
+              frame_rate,
+              record=None):
+        """Starts the emulator GUI in another process and waits for it to
+        be ready. use_LNdigital says whether this process found a real LN
+        Digital at hardware_addr (which it has initialised), the emulator
+        doesn't look for one itself.
+        """
+        connection, child_connection = Pipe()
+        authkey = bytes(current_process().authkey)
+        process = Process(target=_run_emulator,
+                          args=(sysargv,
+                                use_LNdigital,
+                                hardware_addr,
+                                bus,
+                                chip_select,
+                                child_connection,
+                                authkey,
+                                frame_rate,
+                                record))
+        process.start()
+        child_connection.close()
+        # the emulator replies with where to find it once it is ready
+        address, pin_state_name = decode_reply(connection.recv_bytes())[1]
+        if isinstance(address, list):
+            address = tuple(address)  # (host, port)
+        return cls(address,
+                   authkey,
+                   pin_state_name,
+                   process,
+                   EmulatorConnection(connection))
+
+    @classmethod
+    def attach(cls, address, authkey=None):
+        """Connects to an emulator that is already running. authkey
+        defaults to this process's authkey, which is inherited from the
+        process that started the emulator.
+        """
+        if authkey is None:
+            authkey = bytes(current_process().authkey)
+        return cls.connect(address, authkey)
+
+    @classmethod
+    def connect(cls, address, authkey=None):
+        """Connects to an emulator server (see server.serve). There is no
+        authentication if authkey is None.
+        """
+        connection = EmulatorConnection(Client(address, authkey=authkey))
+        pin_state_name = connection.request(('hello',))
+        return cls(address, authkey, pin_state_name, connection=connection)
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = EmulatorConnection(
+                    Client(self.address, authkey=self.authkey))
+            return self._connection
+
+    @property
+    def pin_state_buf(self):
+        with self._lock:
+            if self._pin_state is None and not self._pin_state_missing:
+                try:
+                    self._pin_state = attach_pin_state(self.pin_state_name)
+                except FileNotFoundError:
+                    # the emulator is on another machine
+                    self._pin_state_missing = True
+            if self._pin_state_missing:
+                return None
+            return self._pin_state.buf
+
+    def subscribe_events(self, callback):
+        """Calls callback with each input event, from its own thread. The
+        events come over their own connection so they never get mixed up
+        with replies. Returns a function that unsubscribes.
+        """
+        return self._subscribe('events', decode_event, callback)
+
+    def subscribe_output_events(self, callback):
+        """Calls callback with each output event, like subscribe_events."""
+        return self._subscribe('output_events', decode_output_event, callback)
+
+    def _subscribe(self, kind, decode, callback):
+        connection = Client(self.address, authkey=self.authkey)
+        connection.send_bytes(encode_request(None, (kind,)))
+        connection.recv_bytes()  # wait until we're subscribed
+
+        def read_events():
+            _call_with_each(callback,
+                            lambda: decode(connection.recv_bytes()))
+            connection.close()
+
+        def unsubscribe():
+            # the reading thread gets EOFError and closes the connection
+            with socket.socket(fileno=os.dup(connection.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+
+        _start_thread(read_events)
+        return unsubscribe
+
+
+def _run_emulator(*args):
+    # Qt is only imported here, in the emulator's process
+    from .gui import run_emulator
+    run_emulator(*args)
+
+
+def _call_with_each(callback, get_event):
+    while True:
+        try:
+            event = get_event()
+        except (EOFError, OSError):
+            return  # the emulator has gone
+        if event is None:
+            return  # unsubscribed
+        try:
+            callback(event)
+        except Exception:
+            traceback.print_exc()
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,19 +1,152 @@
 #!/usr/bin/env python3
+import collections
+import os
+import queue
 import sys
-from time import sleep
-from multiprocessing import Process, Queue
+import threading
+import traceback
 import LNcommon.interrupts
 import LNcommon.core
 import LNcommon.mcp23s17
 import LNdigitalIO
-from .gui import run_emulator
+from .clock import VirtualClock
+from .connection import LocalEmulator, RemoteEmulator
+from .pinstate import NUM_LN_DIGITALS, input_state_offset
+from .record import replay
+from .server import default_authkey, parse_address
+from .stats import dump_periodically
 
 # from LNdigitalIO import OUTPUT_PORT, INPUT_PORT
 OUTPUT_PORT = LNcommon.mcp23s17.GPIOA
 INPUT_PORT = LNcommon.mcp23s17.GPIOB
 
+# set to 0 to stop LNdigitals looking for real LN Digitals
+PROBE_HARDWARE_ENV = 'LN_DIGITAL_EMULATOR_PROBE_HARDWARE'
 
-_LNdigitalsDict = dict()
+# what an OutputSubscription does when its buffer is full
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+
+class _LNdigitalsRegistry(dict):
+    """The LNdigitals in this process by hardware address, and the emulator
+    they share.
+    """
+    def __init__(self):
+        super(_LNdigitalsRegistry, self).__init__()
+        self.emulator = None
+        # the options the emulator was started with, see get_emulator
+        self.emulator_options = dict()
+        self.event_dispatchers = dict()
+        # address: RemoteEmulator, for RemoteLNdigitals
+        self.remote_emulators = dict()
+        self.lock = threading.Lock()
+
+    def get_emulator(self, start_emulator, options=None):
+        """Returns the shared emulator, calling start_emulator to start it
+        if there isn't one yet. options are the options (that aren't the
+        defaults) the emulator is wanted with, ValueError is raised if it
+        was started without them.
+        """
+        with self.lock:
+            if self.emulator is None:
+                self.emulator = start_emulator()
+                self.emulator_options = dict(options or {})
+                return self.emulator
+            conflicts = sorted(
+                name for name, value in (options or {}).items()
+                if self.emulator_options.get(name) != value)
+            if conflicts:
+                raise ValueError(
+                    "This process already has an emulator, started without "
+                    "{}. Pass them to the first LNdigitals, or pass "
+                    "emulator.".format(", ".join(
+                        "{}={!r}".format(name, options[name])
+                        for name in conflicts)))
+            return self.emulator
+
+    def get_remote_emulator(self, address, authkey):
+        """Returns the emulator served at address, connecting to it the
+        first time.
+        """
+        with self.lock:
+            if address not in self.remote_emulators:
+                self.remote_emulators[address] = \
+                    RemoteEmulator.connect(address, authkey)
+            return self.remote_emulators[address]
+
+    def share_emulator(self, emulator):
+        """Returns this process's copy of emulator, which has come from
+        another process, so that everything here shares one connection.
+        """
+        with self.lock:
+            if self.emulator is None:
+                self.emulator = emulator
+            if getattr(self.emulator, 'address', None) == emulator.address:
+                return self.emulator
+            return self.remote_emulators.setdefault(
+                emulator.address, emulator)
+
+    def forget_all(self):
+        """Forgets everything, the connections belong to another process
+        (this one has just been forked from it).
+        """
+        self.clear()
+        self.emulator = None
+        self.emulator_options = dict()
+        self.event_dispatchers = dict()
+        self.remote_emulators = dict()
+        self.lock = threading.Lock()
+
+    def get_event_dispatcher(self, emulator):
+        """Returns the _EventDispatcher for emulator, subscribing to its
+        events the first time.
+        """
+        with self.lock:
+            if id(emulator) not in self.event_dispatchers:
+                self.event_dispatchers[id(emulator)] = \
+                    _EventDispatcher(emulator)
+            return self.event_dispatchers[id(emulator)]
+
+
+_LNdigitalsDict = _LNdigitalsRegistry()
+os.register_at_fork(after_in_child=_LNdigitalsDict.forget_all)
+
+# (hardware_addr, bus, chip_select): LNdigitalIO.LNdigitals or None
+_hardware_probes = dict()
+# (bus, chip_select) that couldn't be opened
+_spi_unavailable = set()
+_hardware_probes_lock = threading.Lock()
+
+
+def _probe_hardware(hardware_addr, bus, chip_select, init_board):
+    """Returns the real LN Digital at hardware_addr, or None if there isn't
+    one. Each board is only looked for once per process, and if the SPI
+    device can't be opened it isn't tried again for any board.
+    """
+    key = (hardware_addr, bus, chip_select)
+    with _hardware_probes_lock:
+        if (bus, chip_select) in _spi_unavailable:
+            return None
+        if key not in _hardware_probes:
+            LNd = None
+            try:
+                LNd = LNdigitalIO.LNdigitals(
+                    hardware_addr, bus, chip_select, init_board)
+            except LNcommon.spi.SPIInitError as e:
+                print("Error initialising LN Digital: ", e)
+                print("Running without hardware LN Digital.")
+                _spi_unavailable.add((bus, chip_select))
+            except LNdigitalIO.NoLNdigitalDetectedError:
+                print("No LN Digital detected, running without "
+                      "LN Digital.")
+            _hardware_probes[key] = LNd
+        return _hardware_probes[key]
+
+
+def _probe_hardware_by_default():
+    setting = os.environ.get(PROBE_HARDWARE_ENV, '1')
+    return setting.lower() not in ('0', 'no', 'false', 'off')
 
 
 class EmulatorAddressError(Exception):
@@ -21,14 +154,23 @@ class EmulatorAddressError(Exception):
 
 
 class LNdigitalEmulator(object):
+    pipelined = False
+
     def read_bit(self, bit_num, address, hardware_addr=0):
         # This is  a function that belongs to LNcommon
         if address is INPUT_PORT:
-            self.proc_comms_q_to_em.put(('get_in', bit_num, hardware_addr))
-            return self.proc_comms_q_from_em.get(block=True)
+            if self.pin_state_buf is None:
+                # the emulator is on another machine
+                return self.emulator_connection.request(
+                    ('get_in', bit_num, hardware_addr))
+            # the emulator mirrors the inputs into shared memory
+            return (self.pin_state_buf[input_state_offset(hardware_addr)]
+                    >> bit_num) & 1
         elif address is OUTPUT_PORT:
-            self.proc_comms_q_to_em.put(('get_out', bit_num, hardware_addr))
-            return self.proc_comms_q_from_em.get(block=True)
+            if self.pipelined:
+                self._send_pending_writes()
+            return self.emulator_connection.request(
+                ('get_out', bit_num, hardware_addr))
         else:
             raise EmulatorAddressError(
                 "Reading to 0x%X is not supported in the "
@@ -37,7 +179,12 @@ class LNdigitalEmulator(object):
     def write_bit(self, value, bit_num, address, hardware_addr=0):
         """This is a function that belongs to LNcommon"""
         if address is OUTPUT_PORT:
-            self.proc_comms_q_to_em.put(
+            if self.pipelined:
+                self._queue_write(1 << bit_num,
+                                  0xff if value else 0x00,
+                                  hardware_addr)
+                return
+            self.emulator_connection.send(
                 ('set_out', bit_num, True if value else False, hardware_addr))
         else:
             raise EmulatorAddressError(
@@ -45,13 +192,17 @@ class LNdigitalEmulator(object):
                 "emulator" % address)
 
     def read(self, address, hardware_addr=0):
-        if address is INPUT_PORT or address is OUTPUT_PORT:
-            value = 0x00
-            for i in range(8):
-                value |= self.read_bit(i, address, hardware_addr) << i
-
-            return value
-
+        if address is INPUT_PORT:
+            if self.pin_state_buf is None:
+                return self.emulator_connection.request(
+                    ('get_port', address, hardware_addr))
+            return self.pin_state_buf[input_state_offset(hardware_addr)]
+        elif address is OUTPUT_PORT:
+            # go through the emulator so that we see any pending writes
+            if self.pipelined:
+                self._send_pending_writes()
+            return self.emulator_connection.request(
+                ('get_port', address, hardware_addr))
         else:
             raise EmulatorAddressError(
                 "Reading from 0x%X is not supported in the LN Digital "
@@ -59,84 +210,635 @@ class LNdigitalEmulator(object):
 
     def write(self, data, address, hardware_addr=0):
         if address is OUTPUT_PORT:
-            for i in range(8):
-                value = (data >> i) & 1
-                self.write_bit(value, i, address, hardware_addr)
-
+            if self.pipelined:
+                self._queue_write(0xff, data, hardware_addr)
+                return
+            self.emulator_connection.send(
+                ('set_port', address, data & 0xff, hardware_addr))
         else:
             raise EmulatorAddressError(
                 "Writing to 0x%X is not supported in the LN Digital "
                 "emulator" % address)
 
+    def write_masked(self, value, mask, hardware_addr=None):
+        """Sets the outputs in mask to the matching bits of value and leaves
+        the rest alone, in one emulator operation.
+        """
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        mask &= 0xff
+        if self.pipelined:
+            self._queue_write(mask, value, hardware_addr)
+            return
+        self.emulator_connection.send(
+            ('set_masked', mask, value & mask, hardware_addr))
+
+    def set_bits(self, mask, hardware_addr=None):
+        """Turns on the outputs in mask."""
+        self.write_masked(0xff, mask, hardware_addr)
+
+    def clear_bits(self, mask, hardware_addr=None):
+        """Turns off the outputs in mask."""
+        self.write_masked(0x00, mask, hardware_addr)
+
+    def toggle_bits(self, mask, hardware_addr=None):
+        """Flips the outputs in mask, in one emulator operation."""
+        if hardware_addr is None:
+            hardware_addr = self.hardware_addr
+        if self.pipelined:
+            # the emulator has to flip the outputs after the pending writes
+            self._send_pending_writes()
+        self.emulator_connection.send(
+            ('toggle_masked', mask & 0xff, hardware_addr))
+
     def spisend(self, bytes_to_send):
         raise FunctionNotImplemented("spisend")
 
-"""
-# TODO have not yet implemented interupt functions in emulator
-def wait_for_input(input_func_map=None, loop=False, timeout=None):
-    raise FunctionNotImplemented("wait_for_input")
-"""
+    def flush(self):
+        """Blocks until the emulator has applied every write made so far.
+        Raises the error if the writer thread failed to send some of them.
+        """
+        if self.pipelined:
+            self._send_pending_writes()
+            error, self._write_error = self._write_error, None
+            if error is not None:
+                raise error
+        self.emulator_connection.request(('sync',))
+
+    def _start_write_pipeline(self):
+        """Pipelined writes return straight away. They are coalesced into
+        the last value of each pin and sent by a writer thread, which waits
+        for the emulator to catch up before sending the next batch.
+        """
+        self.pipelined = True
+        # hardware_addr: (mask, value)
+        self._pending_writes = dict()
+        self._pending_writes_changed = threading.Condition()
+        # keeps batches in order between the writer thread and flush
+        self._send_writes_lock = threading.Lock()
+        # what went wrong in the writer thread, for flush to raise
+        self._write_error = None
+        writer = threading.Thread(target=self._run_write_pipeline)
+        writer.daemon = True
+        writer.start()
+
+    def _queue_write(self, mask, value, hardware_addr):
+        with self._pending_writes_changed:
+            old_mask, old_value = \
+                self._pending_writes.get(hardware_addr, (0x00, 0x00))
+            self._pending_writes[hardware_addr] = (
+                old_mask | mask, (old_value & ~mask | value & mask) & 0xff)
+            self._pending_writes_changed.notify()
+
+    def _send_pending_writes(self):
+        """Sends the pending writes, returns True if there were any."""
+        with self._send_writes_lock:
+            with self._pending_writes_changed:
+                pending = self._pending_writes
+                self._pending_writes = dict()
+            for hardware_addr, (mask, value) in pending.items():
+                self.emulator_connection.send(
+                    ('set_masked', mask, value, hardware_addr))
+        return len(pending) > 0
+
+    def _run_write_pipeline(self):
+        while True:
+            with self._pending_writes_changed:
+                while not self._pending_writes:
+                    self._pending_writes_changed.wait()
+            try:
+                if self._send_pending_writes():
+                    # writes coalesce while the emulator works through these
+                    self.emulator_connection.request(('sync',))
+            except Exception as error:
+                self._write_error = error
+
+    def replay(self, file_name, speed=1.0):
+        """Sets the emulator's inputs as they changed in a recorded log,
+        see record.replay.
+        """
+        return replay(
+            file_name, self.emulator_connection, speed, self.emulator.clock)
+
+    def stats(self):
+        """Returns the emulator's statistics and this process's: how many
+        of each request the emulator has handled and the time taken to
+        handle input events (and redraw, in the GUI), and the round trip
+        times of requests from this process and the time from an input
+        changing to its events being dispatched here.
+        """
+        return {'emulator': self.emulator_connection.request(('stats',)),
+                'client': self.emulator_connection.stats.as_dict()}
+
+    def dump_stats(self, file_name, interval=1.0):
+        """Appends stats() to file_name as a line of JSON every interval
+        seconds.
+        """
+        return dump_periodically(self.stats, file_name, interval)
+
+    def wait_for_edge(self,
+                      pin_num,
+                      direction=LNdigitalIO.IODIR_BOTH,
+                      timeout=None):
+        """Blocks until input pin_num changes in direction. Returns the
+        InterruptEvent, or None if timeout seconds pass first.
+        """
+        events = queue.Queue()
+        listener = InputEventListener(chip=self)
+        listener.register(pin_num, direction, events.put)
+        listener.activate()
+        try:
+            return self._get_event(events, timeout)
+        finally:
+            listener.deactivate()
+
+    def wait_for_input(self, input_func_map=None, loop=False, timeout=None):
+        """Blocks until an input changes and calls the functions in
+        input_func_map (a list of LNcommon.interrupts.PinFunctionMap) that
+        match the change. With loop=True it carries on until one of the
+        functions returns False or timeout seconds have passed.
+
+        Returns the last InterruptEvent, or None if there wasn't one.
+        """
+        events = queue.Queue()
+        listener = InputEventListener(chip=self)
+        for pin_num in range(8):
+            listener.register(pin_num, LNdigitalIO.IODIR_BOTH, events.put)
+        listener.activate()
+        clock = self.emulator.clock
+        if timeout is not None:
+            deadline = clock.monotonic() + timeout
+        last_event = None
+        try:
+            while True:
+                if timeout is not None:
+                    timeout = max(0, deadline - clock.monotonic())
+                event = self._get_event(events, timeout)
+                if event is None:
+                    return last_event
+                last_event = event
+
+                carry_on = loop
+                for funcmap in input_func_map or list():
+                    if (funcmap.pin_num == event.pin_num and
+                            (funcmap.direction == LNdigitalIO.IODIR_BOTH or
+                             funcmap.direction == event.direction)):
+                        if funcmap.callback(event) is False:
+                            carry_on = False
+                if not carry_on:
+                    return last_event
+        finally:
+            listener.deactivate()
+
+    def _get_event(self, events, timeout):
+        """Returns the next event from the queue events, or None if timeout
+        seconds pass first. In virtual time the clock is moved on until
+        there is an event.
+        """
+        clock = self.emulator.clock
+        if not clock.virtual:
+            try:
+                return events.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        if timeout is not None:
+            deadline = clock.monotonic() + timeout
+        else:
+            deadline = None
+        while events.empty():
+            if not clock.run_next_timer(deadline):
+                if deadline is None:
+                    raise RuntimeError(
+                        "Nothing is scheduled to change the inputs, "
+                        "this would wait forever.")
+                clock.advance_to(deadline)
+                return None
+        return events.get()
+
+    def sleep(self, seconds):
+        """Sleeps in the emulator's time, which returns straight away in
+        virtual time (after moving the clock on).
+        """
+        self.emulator.clock.sleep(seconds)
+
+    def subscribe_outputs(self, maxlen=1024, policy=DROP_OLDEST):
+        """Returns an OutputSubscription to the changes of this board's
+        outputs.
+        """
+        return OutputSubscription(self, maxlen, policy)
 
 
 class LNdigitals(LNdigitalEmulator, LNdigitalIO.LNdigitals):
+    """An emulated LN Digital.
+
+    Every LNdigitals in a process shares one emulator, which serves all
+    four hardware addresses. The first LNdigitals starts it: by default
+    with a GUI in another process, or in this process without Qt if
+    ``headless=True``. To use a particular emulator pass it as emulator,
+    or use attach_emulator to share one that is already running.
+
+    With ``pipelined=True`` output writes do not wait for the emulator and
+    writes to the same pin are coalesced; use flush() to wait for them.
+
+    frame_rate caps how many times a second the GUI redraws.
+
+    A real LN Digital at hardware_addr is mirrored by the emulator. It is
+    only looked for once per process, and not at all if probe_hardware is
+    False (it defaults to the LN_DIGITAL_EMULATOR_PROBE_HARDWARE environment
+    variable, or True).
+
+    record is a file to record the emulator's requests and input changes
+    to (see record).
+
+    headless, frame_rate, record and virtual_time are how the emulator is
+    started, so they only need to be given to the first LNdigitals in a
+    process; ValueError is raised if a later one asks for something else.
+
+    An LNdigitals can be pickled and sent to other processes (a
+    multiprocessing.Pool's workers, say), where it connects to the same
+    emulator and board. The emulator takes turns between its clients.
+    Headless emulators are only in the process that made them so they can't
+    be shared.
+
+    With ``virtual_time=True`` (which needs ``headless=True``) the emulator
+    runs on a clock.VirtualClock: sleep() and timeouts jump forward instead
+    of waiting, and inputs only change when the program sleeps or waits.
+    """
     def __init__(self,
                  hardware_addr=0,
                  bus=LNdigitalIO.DEFAULT_SPI_BUS,
                  chip_select=LNdigitalIO.DEFAULT_SPI_CHIP_SELECT,
-                 init_board=True):
+                 init_board=True,
+                 headless=False,
+                 pipelined=False,
+                 frame_rate=60,
+                 emulator=None,
+                 record=None,
+                 probe_hardware=None,
+                 virtual_time=False):
+        if virtual_time and not headless:
+            raise ValueError("Virtual time needs a headless emulator.")
+        if not 0 <= hardware_addr < NUM_LN_DIGITALS:
+            raise ValueError("There is no LN Digital at hardware address "
+                             "{}.".format(hardware_addr))
         self.hardware_addr = hardware_addr
-        try:
-            # check if we can access a real LN digital
-            LNdigitalIO.LNdigitals(
-                hardware_addr, bus, chip_select, init_board)
-            use_LNd = True
+        if probe_hardware is None:
+            probe_hardware = _probe_hardware_by_default()
+        LNd = None
+        if probe_hardware:
+            LNd = _probe_hardware(hardware_addr, bus, chip_select, init_board)
+        use_LNd = LNd is not None
+        if use_LNd:
             # create this false LN Digital
             super(LNdigitals, self).__init__(hardware_addr,
                                                 bus,
                                                 chip_select,
                                                 init_board=False)
-        except LNcommon.spi.SPIInitError as e:
-            print("Error initialising LN Digital: ", e)
-            print("Running without hardware LN Digital.")
-            use_LNd = False
-        except LNdigitalIO.NoLNdigitalDetectedError:
-            print("No LN Digital detected, running without "
-                  "LN Digital.")
-            use_LNd = False
 
-
-        self.proc_comms_q_to_em = Queue()
-        self.proc_comms_q_from_em = Queue()
-
-        # start the gui in another process
-        self.emulator = Process(target=run_emulator,
-                                args=(sys.argv, use_LNd, init_board, self))
+        def start_emulator():
+            if headless:
+                clock = VirtualClock() if virtual_time else None
+                return LocalEmulator(LNd, record, clock)
+            # start the gui in another process
+            return RemoteEmulator.start(sys.argv,
+                                        use_LNd,
+                                        hardware_addr,
+                                        bus,
+                                        chip_select,
+                                        frame_rate,
+                                        record)
 
         global _LNdigitalsDict
+        if emulator is None:
+            options = {'headless': headless,
+                       'frame_rate': frame_rate,
+                       'record': record,
+                       'virtual_time': virtual_time}
+            defaults = {'headless': False,
+                        'frame_rate': 60,
+                        'record': None,
+                        'virtual_time': False}
+            emulator = _LNdigitalsDict.get_emulator(
+                start_emulator,
+                {name: value for name, value in options.items()
+                 if value != defaults[name]})
+        self.emulator = emulator
+        self.emulator_connection = emulator.connection
+        self.pin_state_buf = emulator.pin_state_buf
         _LNdigitalsDict[self.hardware_addr] = self
 
-        self.emulator.start()
+        if pipelined:
+            self._start_write_pipeline()
 
+    def __reduce__(self):
+        # opened again wherever it is unpickled
+        return (_open_LNdigitals,
+                (self.emulator, self.hardware_addr, self.pipelined))
 
-class InputEventListener(object):
-    """PicklingError: Can't pickle <class 'method'>: attribute lookup
-    builtins.method failed
+
+def _open_LNdigitals(emulator, hardware_addr, pipelined):
+    return LNdigitals(hardware_addr,
+                      pipelined=pipelined,
+                      emulator=_LNdigitalsDict.share_emulator(emulator),
+                      probe_hardware=False)
+
+
+class RemoteLNdigitals(LNdigitals):
+    """An emulated LN Digital on an emulator server, which can be on another
+    machine (see ``LN-Digital-Emulator --listen``). address is 'host:port'
+    or a Unix socket path. authkey defaults to the
+    LN_DIGITAL_EMULATOR_AUTHKEY environment variable, with neither there is
+    no authentication.
     """
-    def __init__(self):
-        raise NotImplementedError(
-            "Interrupts are not implemented in the emulator.")
-    # def register(self, pin_num, direction, callback):
-    #     global proc_comms_q_to_em
-    #     proc_comms_q_to_em.put(
-    #         ('register_interrupt', pin_num, direction, callback))
+    def __init__(self,
+                 address,
+                 hardware_addr=0,
+                 authkey=None,
+                 pipelined=False):
+        if authkey is None:
+            authkey = default_authkey()
+        emulator = _LNdigitalsDict.get_remote_emulator(
+            parse_address(address), authkey)
+        super(RemoteLNdigitals, self).__init__(hardware_addr,
+                                               pipelined=pipelined,
+                                               emulator=emulator,
+                                               probe_hardware=False)
+
+
+class InterruptEvent(object):
+    """Inputs changing on an emulated LN Digital. It has the same
+    attributes as the events LNdigitalIO passes to InputEventListener
+    callbacks. interrupt_flag has a bit set for every input that changed at
+    once, pin_num and direction are the lowest one's.
+    """
+    def __init__(self, interrupt_flag, interrupt_capture, chip, timestamp):
+        self.interrupt_flag = interrupt_flag
+        self.interrupt_capture = interrupt_capture
+        self.chip = chip
+        self.timestamp = timestamp
+
+    @property
+    def pin_num(self):
+        # lowest bit set in the flag
+        return (self.interrupt_flag & -self.interrupt_flag).bit_length() - 1
+
+    @property
+    def direction(self):
+        return (self.interrupt_capture >> self.pin_num) & 1
+
+
+class _EventDispatcher(object):
+    """Passes the input events of one emulator to the InputEventListeners
+    that are active on it. Callbacks are called from the dispatcher's
+    thread.
+
+    The callbacks of the active listeners are kept in a table by
+    ``(hardware_addr, pin_num, direction)``, so an event only costs a
+    lookup for each pin that changed however many callbacks there are.
+    IODIR_BOTH callbacks are in the table for both directions.
+    """
+    def __init__(self, emulator):
+        self.listeners = list()
+        # (hardware_addr, pin_num, direction): ((listener, callback), ...)
+        # replaced rather than changed so that dispatch needn't lock
+        self.callbacks = dict()
+        self.lock = threading.Lock()
+        self.clock = emulator.clock
+        self.stats = emulator.connection.stats
+        emulator.subscribe_events(self.dispatch)
+
+    def add(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                return
+            self.listeners.append(listener)
+            for pin_num, direction, callback in listener.pin_function_maps:
+                self._add_callback(listener, pin_num, direction, callback)
+
+    def remove(self, listener):
+        with self.lock:
+            if listener not in self.listeners:
+                return
+            self.listeners.remove(listener)
+            for pin_num, direction, callback in listener.pin_function_maps:
+                self._remove_callback(listener, pin_num, direction, callback)
+
+    def add_callback(self, listener, pin_num, direction, callback):
+        with self.lock:
+            if listener in self.listeners:
+                self._add_callback(listener, pin_num, direction, callback)
+
+    def remove_callback(self, listener, pin_num, direction, callback):
+        with self.lock:
+            if listener in self.listeners:
+                self._remove_callback(listener, pin_num, direction, callback)
+
+    def _keys(self, listener, pin_num, direction):
+        if direction == LNdigitalIO.IODIR_BOTH:
+            directions = (LNdigitalIO.IODIR_ON, LNdigitalIO.IODIR_OFF)
+        else:
+            directions = (direction,)
+        return [(listener.chip.hardware_addr, pin_num, direction)
+                for direction in directions]
+
+    def _add_callback(self, listener, pin_num, direction, callback):
+        for key in self._keys(listener, pin_num, direction):
+            self.callbacks[key] = \
+                self.callbacks.get(key, ()) + ((listener, callback),)
+
+    def _remove_callback(self, listener, pin_num, direction, callback):
+        for key in self._keys(listener, pin_num, direction):
+            callbacks = list(self.callbacks.get(key, ()))
+            if (listener, callback) in callbacks:
+                callbacks.remove((listener, callback))
+            if callbacks:
+                self.callbacks[key] = tuple(callbacks)
+            else:
+                self.callbacks.pop(key, None)
+
+    def dispatch(self, event):
+        hardware_addr, flag, capture, timestamp = event
+        changed = flag
+        while changed:
+            pin_flag = changed & -changed
+            changed ^= pin_flag
+            pin_num = pin_flag.bit_length() - 1
+            key = (hardware_addr, pin_num, (capture >> pin_num) & 1)
+            # callbacks are passed an event for their own pin
+            for listener, callback in self.callbacks.get(key, ()):
+                try:
+                    callback(InterruptEvent(
+                        pin_flag, capture, listener.chip, timestamp))
+                except Exception:
+                    # one broken callback mustn't stop the events
+                    traceback.print_exc()
+        # from the input changing to the callbacks being done
+        self.stats.add_time('event_dispatch', self.clock.time() - timestamp)
+
+
+class OutputChange(object):
+    """The outputs of an emulated LN Digital changing from old_value to
+    new_value. source is what changed them: 'client' (an LNdigitals) or
+    the GUI's 'override' buttons, 'all_on', 'all_off' or 'flip'.
+    """
+    def __init__(self, chip, old_value, new_value, timestamp, source):
+        self.chip = chip
+        self.old_value = old_value
+        self.new_value = new_value
+        self.timestamp = timestamp
+        self.source = source
+
+    @property
+    def changed_pins(self):
+        changed = self.old_value ^ self.new_value
+        return [pin_num for pin_num in range(8) if (changed >> pin_num) & 1]
+
+    def __repr__(self):
+        return "OutputChange(hardware_addr={}, {:#04x} -> {:#04x}, " \
+            "source={!r})".format(self.chip.hardware_addr,
+                                  self.old_value,
+                                  self.new_value,
+                                  self.source)
+
+
+class OutputSubscription(object):
+    """The changes of an emulated LN Digital's outputs, pushed by the
+    emulator as they happen and buffered for one subscriber.
+
+    Every subscription has its own channel from the emulator and its own
+    buffer of at most maxlen changes. When the buffer is full the
+    DROP_OLDEST policy drops the oldest change (counting it in dropped)
+    and BLOCK stops taking changes from the channel until the subscriber
+    catches up. Neither holds up the emulator or other subscriptions: if a
+    channel falls too far behind the emulator drops its oldest changes,
+    counted as events_dropped in its stats. BLOCK can't be used in virtual
+    time, where the changes are delivered by the thread that writes.
+
+    >>> with LNd.subscribe_outputs() as outputs:
+    ...     for change in outputs:
+    ...         print(change)
+    """
+    def __init__(self, chip, maxlen=1024, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown policy {!r}.".format(policy))
+        if policy == BLOCK and chip.emulator.clock.virtual:
+            raise ValueError("BLOCK would deadlock in virtual time.")
+        self.chip = chip
+        self.maxlen = maxlen
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.changes = collections.deque()
+        self.changes_changed = threading.Condition()
+        self.unsubscribe = chip.emulator.subscribe_output_events(
+            self.handle_event)
+
+    def handle_event(self, event):
+        hardware_addr, old_value, new_value, timestamp, source = event
+        if hardware_addr == self.chip.hardware_addr:
+            self.put(OutputChange(
+                self.chip, old_value, new_value, timestamp, source))
+
+    def put(self, change):
+        with self.changes_changed:
+            if self.policy == BLOCK:
+                self.changes_changed.wait_for(
+                    lambda: len(self.changes) < self.maxlen or self.closed)
+                if self.closed:
+                    return
+            elif len(self.changes) >= self.maxlen:
+                self.changes.popleft()
+                self.dropped += 1
+            self.changes.append(change)
+            self.changes_changed.notify_all()
+
+    def get(self, timeout=None):
+        """Returns the next OutputChange, or None if timeout seconds pass
+        first or the subscription is closed.
+        """
+        with self.changes_changed:
+            self.changes_changed.wait_for(
+                lambda: self.changes or self.closed, timeout)
+            if not self.changes:
+                return None
+            change = self.changes.popleft()
+            self.changes_changed.notify_all()
+            return change
+
+    def __iter__(self):
+        while True:
+            change = self.get()
+            if change is None:
+                return
+            yield change
+
+    def close(self):
+        self.unsubscribe()
+        with self.changes_changed:
+            self.closed = True
+            self.changes_changed.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
-    # def activate(self):
-    #     global proc_comms_q_to_em
-    #     proc_comms_q_to_em.put(('activate_interrupt',))
+class InputEventListener(object):
+    """Calls functions when the inputs of an emulated LN Digital change,
+    like LNdigitalIO.InputEventListener. The events come from the emulator
+    as they happen, there is no polling.
 
-    # def deactivate(self):
-    #     global proc_comms_q_to_em
-    #     proc_comms_q_to_em.put(('deactivate_interrupt',))
+    >>> listener = InputEventListener(chip=LNd)
+    >>> listener.register(0, IODIR_ON, print)
+    >>> listener.activate()
+    """
+    def __init__(self, chip=None):
+        if chip is None:
+            chip = _LNdigitalsDict.get(0) or LNdigitals()
+        self.chip = chip
+        self.pin_function_maps = list()
+
+    def register(self, pin_num, direction, callback):
+        """Calls callback(event) when pin_num changes in direction
+        (IODIR_ON, IODIR_OFF or IODIR_BOTH). A pin can have any number of
+        callbacks.
+        """
+        self.pin_function_maps.append((pin_num, direction, callback))
+        self._get_dispatcher().add_callback(
+            self, pin_num, direction, callback)
+
+    def unregister(self, pin_num, direction, callback=None):
+        """Stops calling callback, or every callback if it is None, when
+        pin_num changes in direction.
+        """
+        for pin_function_map in list(self.pin_function_maps):
+            if (pin_function_map[:2] == (pin_num, direction) and
+                    callback in (None, pin_function_map[2])):
+                self.pin_function_maps.remove(pin_function_map)
+                self._get_dispatcher().remove_callback(
+                    self, *pin_function_map)
+
+    def activate(self):
+        self._get_dispatcher().add(self)
+
+    def deactivate(self):
+        self._get_dispatcher().remove(self)
+
+    def _get_dispatcher(self):
+        return _LNdigitalsDict.get_event_dispatcher(self.chip.emulator)
+
+
+def attach_emulator(address, authkey=None):
+    """Connects to an emulator that is already running (see
+    RemoteEmulator.address), LNdigitals created from now on will use it.
+    """
+    with _LNdigitalsDict.lock:
+        _LNdigitalsDict.emulator = RemoteEmulator.attach(address, authkey)
+        _LNdigitalsDict.emulator_options = dict()
+        return _LNdigitalsDict.emulator
 
 
 def init():
@@ -147,6 +849,26 @@ def deinit():
     pass
 
 
+def wait_for_input(input_func_map=None,
+                   loop=False,
+                   timeout=None,
+                   hardware_addr=0):
+    return _LNdigitalsDict[hardware_addr].wait_for_input(
+        input_func_map, loop, timeout)
+
+
+def wait_for_edge(pin_num,
+                  direction=LNdigitalIO.IODIR_BOTH,
+                  timeout=None,
+                  hardware_addr=0):
+    return _LNdigitalsDict[hardware_addr].wait_for_edge(
+        pin_num, direction, timeout)
+
+
+def sleep(seconds, hardware_addr=0):
+    _LNdigitalsDict[hardware_addr].sleep(seconds)
+
+
 def digital_read(pin_num, hardware_addr=0):
     return _LNdigitalsDict[hardware_addr].read_bit(pin_num,
                                                    INPUT_PORT,
@@ -0,0 +1,366 @@
+"""The emulator itself: the pin state of the emulated LN Digitals and the
+requests LNdigitals sends to them. Nothing in here needs Qt, the GUI is just a
+view attached to an EmulatorEngine.
+"""
+import queue
+import threading
+import time
+import LNcommon
+import LNcommon.mcp23s17
+from .clock import REAL_CLOCK
+from .pinstate import (
+    NUM_LN_DIGITALS,
+    input_state_offset,
+    output_state_offset,
+    states_to_value,
+)
+from .stats import Stats
+
+
+OUTPUT_PORT = LNcommon.mcp23s17.GPIOA
+INPUT_PORT = LNcommon.mcp23s17.GPIOB
+
+# tasks whose first arg is a pin number
+PIN_TASKS = ('set_out', 'get_in', 'get_out', 'set_in')
+# tasks that aren't for a board, so have no hardware_addr
+BOARDLESS_TASKS = ('sync', 'stats')
+
+
+class EmulatedLNdigital(object):
+    """The input and output state of an emulated LN Digital.
+
+    Every method that changes the state takes the lock and finishes with
+    update(), which tells the attached views and interrupt handlers.
+    """
+    def __init__(self, hardware_addr=0, LNdigital=None, pin_state=None):
+        self.hardware_addr = hardware_addr
+        # real LN Digital to mirror, if there is one
+        self.LNdigital = LNdigital
+        # buffer (shared memory) the pin state is mirrored into
+        self.pin_state = pin_state
+        self.lock = threading.RLock()
+
+        self.input_state = [False for state in range(8)]
+        self.previous_input_value = self.get_input_as_value()
+        self.output_state = [False for state in range(8)]
+        # 'hold' for every input
+        self.input_hold = [False for state in range(8)]
+        self.output_override_enabled = False
+        self._saved_output_state = list(self.output_state)
+        self.previous_output_value = self.get_output_as_value()
+
+        # called with this board after every update
+        self.update_callbacks = list()
+        # called with (board, changed_pins) when inputs change, changed_pins
+        # is a mask of every input that changed in the update
+        self.interrupt_callbacks = list()
+        # called with (board, old_value, new_value, source) when the
+        # outputs change, source is one of OUTPUT_SOURCES
+        self.output_callbacks = list()
+
+    def set_output(self, index, enable):
+        """Sets the specified output on or off"""
+        if not self.output_override_enabled:
+            self.output_state[index] = enable
+
+    def set_output_port(self, value):
+        self.set_output_masked(0xff, value)
+
+    def set_output_masked(self, mask, value):
+        """Sets the outputs in mask to the matching bits of value."""
+        with self.lock:
+            for pin_num in range(8):
+                if (mask >> pin_num) & 1:
+                    self.set_output(pin_num, bool((value >> pin_num) & 1))
+            self.update()
+
+    def toggle_output_masked(self, mask):
+        """Flips the outputs in mask."""
+        with self.lock:
+            self.set_output_masked(mask, ~self.get_output_as_value())
+
+    def set_input(self, index, enable):
+        # don't set the input if it is being held
+        if not self.input_hold[index]:
+            self.input_state[index] = enable
+
+    def set_input_pin(self, index, enable):
+        """Sets an input, whether or not it is held."""
+        with self.lock:
+            self.input_state[index] = enable
+            self.update()
+
+    def set_input_port(self, value):
+        """Sets every input to the matching bit of value."""
+        with self.lock:
+            self.input_state = [bool((value >> i) & 1) for i in range(8)]
+            self.update()
+
+    def press_input(self, index, switch):
+        """Presses an input. Switches are on until released, pins are
+        toggled and held while they are on.
+        """
+        with self.lock:
+            if switch:
+                self.input_state[index] = True
+            else:
+                self.input_state[index] = not self.input_state[index]
+                # hold it if we're setting it the pin high
+                self.input_hold[index] = self.input_state[index]
+            self.update()
+
+    def release_input(self, index):
+        """Releases an input, turning it off if it is not held."""
+        with self.lock:
+            if not self.input_hold[index]:
+                self.input_state[index] = False
+                self.update()
+
+    def get_output_as_value(self):
+        return states_to_value(self.output_state)
+
+    def get_input_as_value(self):
+        return states_to_value(self.input_state)
+
+    def enable_output_override(self, enable):
+        """While the override is enabled set_output is ignored and the
+        outputs are controlled with set_output_override.
+        """
+        with self.lock:
+            if enable:
+                self._saved_output_state = list(self.output_state)
+            else:
+                self.output_state = self._saved_output_state
+            self.output_override_enabled = enable
+            if not enable:
+                self.update('override')
+
+    def set_output_override(self, states, source='override'):
+        """Sets the outputs, ignoring the override lock."""
+        with self.lock:
+            self.output_state = list(states)
+            self.update(source)
+
+    def all_outputs_on(self):
+        self.set_output_override([True for s in range(8)], 'all_on')
+
+    def all_outputs_off(self):
+        self.set_output_override([False for s in range(8)], 'all_off')
+
+    def all_outputs_toggle(self):
+        with self.lock:
+            self.set_output_override(
+                [not s for s in self.output_state], 'flip')
+
+    def set_input_pullups(self, enable):
+        with self.lock:
+            if self.LNdigital is not None:
+                self.LNdigital.gppub.value = 0xff if enable else 0x00
+                if not enable:
+                    for i, s in enumerate(self.input_state):
+                        self.set_input(i, False)
+                    self.update()
+
+    def update_LN(self):
+        self.LNdigital.output_port.value = self.get_output_as_value()
+
+    def update_pin_state(self):
+        """Mirrors the pin state into the pin state buffer."""
+        self.pin_state[input_state_offset(self.hardware_addr)] = \
+            self.get_input_as_value()
+        self.pin_state[output_state_offset(self.hardware_addr)] = \
+            self.get_output_as_value()
+
+    def update(self, source='client'):
+        """Tells everything attached to the board about any changes, which
+        were made by source (see OUTPUT_SOURCES).
+        """
+        with self.lock:
+            if self.pin_state is not None:
+                self.update_pin_state()
+            output_value = self.get_output_as_value()
+            if output_value != self.previous_output_value:
+                for callback in self.output_callbacks:
+                    callback(self,
+                             self.previous_output_value,
+                             output_value,
+                             source)
+                self.previous_output_value = output_value
+            changed_pins = self.get_changed_inputs()
+            if changed_pins:
+                for callback in self.interrupt_callbacks:
+                    callback(self, changed_pins)
+            self.previous_input_value ^= changed_pins
+
+            if self.LNdigital is not None:
+                self.update_LN()
+
+            for callback in self.update_callbacks:
+                callback(self)
+
+    def get_changed_inputs(self):
+        """Returns a mask of the inputs that have changed since the last
+        update.
+        """
+        return self.get_input_as_value() ^ self.previous_input_value
+
+
+class EventQueue(queue.Queue):
+    """A bounded queue of events for a reader that can fall behind. The
+    engine calls put() with a board locked, so it never waits: when the
+    queue is full the oldest event is dropped, and counted as
+    events_dropped in stats.
+    """
+    def __init__(self, maxsize, stats):
+        super(EventQueue, self).__init__(maxsize)
+        self.stats = stats
+
+    def put(self, event):
+        with self.mutex:
+            if self._qsize() >= self.maxsize:
+                self._get()
+                self.stats.count('events_dropped')
+            self._put(event)
+            self.not_empty.notify()
+
+
+class EmulatorEngine(object):
+    """Handles the requests LNdigitals makes of the emulator.
+
+    There is a board for every hardware address, each with its own lock so
+    that requests for different boards do not wait for each other. Requests
+    are tuples of ``(task, *args, hardware_addr)``; handle() returns the
+    reply or None if the task has no reply.
+
+    When an input changes the functions in event_callbacks are called with
+    ``(hardware_addr, interrupt_flag, interrupt_capture, timestamp)``, like
+    the interrupt flag and capture registers of the real board: flag bits
+    are set for the pins that changed and capture bits are clear for the
+    inputs that are on. Every input that changed in an update is in the
+    one event. Timestamps come from clock, real time by default.
+
+    When the outputs change the functions in output_event_callbacks are
+    called with ``(hardware_addr, old_value, new_value, timestamp,
+    source)``, source being one of OUTPUT_SOURCES.
+    """
+    def __init__(self, LNdigital=None, pin_state=None, clock=None):
+        self.clock = REAL_CLOCK if clock is None else clock
+        self.boards = [EmulatedLNdigital(hardware_addr, pin_state=pin_state)
+                       for hardware_addr in range(NUM_LN_DIGITALS)]
+        # mirror the real LN Digital, if there is one
+        if LNdigital is not None:
+            self.boards[LNdigital.hardware_addr].LNdigital = LNdigital
+        for board in self.boards:
+            board.interrupt_callbacks.append(self.handle_interrupt)
+            board.output_callbacks.append(self.handle_output_change)
+        self.perform = {
+            'set_out': self.set_out_pin,
+            'get_in': self.get_in_pin,
+            'get_out': self.get_out_pin,
+            'set_port': self.set_port,
+            'get_port': self.get_port,
+            'set_masked': self.set_masked,
+            'toggle_masked': self.toggle_masked,
+            'set_in': self.set_in_pin,
+            'set_in_port': self.set_in_port,
+            'sync': self.sync,
+            'stats': self.get_stats,
+        }
+        self.event_callbacks = list()
+        self.output_event_callbacks = list()
+        # called with every request before it is handled
+        self.request_callbacks = list()
+        self.stats = Stats()
+
+    def handle(self, action):
+        self.check(action)
+        for callback in self.request_callbacks:
+            callback(action)
+        task = action[0]
+        self.stats.count(task)
+        return self.perform[task](action[1:])
+
+    def check(self, action):
+        """Raises ValueError if action isn't a request the emulator can
+        handle, before it gets near the boards.
+        """
+        task = action[0]
+        if task not in self.perform:
+            raise ValueError("Unknown task {!r}.".format(task))
+        if (task not in BOARDLESS_TASKS and
+                not 0 <= action[-1] < NUM_LN_DIGITALS):
+            raise ValueError("There is no LN Digital at hardware address "
+                             "{}.".format(action[-1]))
+        if task in PIN_TASKS and not 0 <= action[1] < 8:
+            raise ValueError("There is no pin {}.".format(action[1]))
+
+    def set_out_pin(self, data):
+        pin, enable, hardware_addr = data
+        board = self.boards[hardware_addr]
+        with board.lock:
+            board.set_output(pin, bool(enable))
+            board.update()
+
+    def get_in_pin(self, data):
+        pin, hardware_addr = data
+        return 1 if self.boards[hardware_addr].input_state[pin] else 0
+
+    def get_out_pin(self, data):
+        pin, hardware_addr = data
+        return 1 if self.boards[hardware_addr].output_state[pin] else 0
+
+    def set_port(self, data):
+        # only the output port can be written to, core checks this
+        port, value, hardware_addr = data
+        self.boards[hardware_addr].set_output_port(value)
+
+    def get_port(self, data):
+        port, hardware_addr = data
+        if port == INPUT_PORT:
+            return self.boards[hardware_addr].get_input_as_value()
+        else:
+            return self.boards[hardware_addr].get_output_as_value()
+
+    def set_masked(self, data):
+        mask, value, hardware_addr = data
+        self.boards[hardware_addr].set_output_masked(mask, value)
+
+    def toggle_masked(self, data):
+        mask, hardware_addr = data
+        self.boards[hardware_addr].toggle_output_masked(mask)
+
+    def set_in_pin(self, data):
+        pin, enable, hardware_addr = data
+        self.boards[hardware_addr].set_input_pin(pin, bool(enable))
+
+    def set_in_port(self, data):
+        value, hardware_addr = data
+        self.boards[hardware_addr].set_input_port(value)
+
+    def sync(self, data):
+        # requests are handled in order, so everything sent before this
+        # has been applied
+        return True
+
+    def get_stats(self, data):
+        return self.stats.as_dict()
+
+    def handle_interrupt(self, board, changed_pins):
+        capture = 0xff ^ board.get_input_as_value()
+        event = (board.hardware_addr,
+                 changed_pins,
+                 capture,
+                 self.clock.time())
+        start = time.perf_counter()
+        for callback in self.event_callbacks:
+            callback(event)
+        self.stats.add_time('event_callbacks', time.perf_counter() - start)
+
+    def handle_output_change(self, board, old_value, new_value, source):
+        event = (board.hardware_addr,
+                 old_value,
+                 new_value,
+                 self.clock.time(),
+                 source)
+        for callback in self.output_event_callbacks:
+            callback(event)
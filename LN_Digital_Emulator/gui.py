@@ -1,14 +1,17 @@
 from PySide import QtGui, QtCore
-from PySide.QtCore import (Qt, QThread, QObject, Slot, Signal)
+from PySide.QtCore import (Qt, QThread, QObject, Slot)
 from PySide.QtGui import (
     QMainWindow, QPushButton, QApplication, QPainter, QFont
 )
-from multiprocessing import Queue
 from threading import Barrier
+import time
 
-import LNcommon
 import LNdigitalIO
 from .LN_Digital_Emulator_ui import Ui_LN_DigitalEmulatorWindow
+from .engine import EmulatorEngine
+from .pinstate import create_pin_state
+from .record import Recorder
+from .server import EmulatorServer
 
 
 # circle drawing
@@ -58,7 +61,8 @@ PIN_BOUNDARY_X_LEFT = ((5,  19, 31, 44, 53, 68, 79, 91, 104),
 PIN_BOUNDARY_X_RIGHT = ((15, 27, 38, 51, 66, 74, 87, 99, 112),
                         (180, 168, 156, 144, 132, 120, 108, 96))
 
-NUM_LN_DIGITALS = 4
+# maximum number of times a second the emulator is redrawn
+DEFAULT_FRAME_RATE = 60
 
 
 class CircleDrawingWidget(QtGui.QWidget):
@@ -67,9 +71,6 @@ class CircleDrawingWidget(QtGui.QWidget):
         # mirror actual state
         self.emu_window = emu_window
 
-        # 'hold' for every input
-        self.input_hold = [False for i in self.emu_window.input_state]
-
     @property
     def switch_circles_state(self):
         return self.emu_window.input_state[:4]
@@ -91,6 +92,12 @@ class CircleDrawingWidget(QtGui.QWidget):
         return state1 + state0
 
     def paintEvent(self, event):
+        start = time.perf_counter()
+        self.paint_circles()
+        self.emu_window.emulator.stats.add_time(
+            'paint', time.perf_counter() - start)
+
+    def paint_circles(self):
         painter = QtGui.QPainter(self)
         painter.setBrush(QtGui.QBrush(PIN_COLOUR))
         painter.setPen(QtGui.QPen(PIN_COLOUR))
@@ -138,16 +145,8 @@ class CircleDrawingWidget(QtGui.QWidget):
             return
 
         # if we are over a switch, turn it on, else toggle
-        if self._pressed_switch:
-            self.emu_window.input_state[self._pressed_pin] = True
-        else:
-            self.emu_window.input_state[self._pressed_pin] = \
-                not self.emu_window.input_state[self._pressed_pin]
-            # hold it if we're setting it the pin high
-            self.input_hold[self._pressed_pin] = \
-                self.emu_window.input_state[self._pressed_pin]
-
-        self.emu_window.update_emulator()
+        self.emu_window.board.press_input(
+            self._pressed_pin, self._pressed_switch)
 
     def mouseReleaseEvent(self, event):
         if self._pressed_pin is None:
@@ -156,30 +155,27 @@ class CircleDrawingWidget(QtGui.QWidget):
 
         # if we're releasing a switch, turn off the pin (if it's not held)
         if self._pressed_switch:
-            if not self.input_hold[self._pressed_pin]:
-                self.emu_window.input_state[self._pressed_pin] = False
-                self._pressed_pin = None
-                self._pressed_switch = False
-                self.emu_window.update_emulator()
+            self.emu_window.board.release_input(self._pressed_pin)
+            self._pressed_pin = None
+            self._pressed_switch = False
 
 
 class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
-    def __init__(self, parent=None):
+    """A view of an EmulatorEngine, showing one of its boards at a time.
+    The address menu chooses which board is shown.
+
+    Changes to the board only mark the view as dirty, it is redrawn at most
+    frame_rate times a second.
+    """
+    def __init__(self, emulator, parent=None, frame_rate=DEFAULT_FRAME_RATE):
         super(LNdigitalEmulatorWindow, self).__init__(parent)
         self.setupUi(self)
 
-        self.LNdigital = None
+        self.emulator = emulator
+        self.board = emulator.boards[0]
         self.current_LN = 0
         self.LNdig_ver = 1
-
-        # self._input_states = [[False for state in range(8)]
-        #                       for p in range(NUM_LN_DIGITALS)]
-        # self._previous_input_states = [list(p) for p in self._input_states]
-        # self._output_states = [[False for state in range(8)]
-        #                        for p in range(NUM_LN_DIGITALS)]
-        self.input_state = [False for state in range(8)]
-        self.previous_input_state = list(self.input_state)
-        self.output_state = [False for state in range(8)]
+        self.view_dirty = True
 
         # add the circle drawing widget
         self.circleDrawingWidget = \
@@ -238,8 +234,28 @@ class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
         self.address2Action.toggled.connect(self.address2ActionToggled)
         self.address3Action.toggled.connect(self.address3ActionToggled)
 
-        self.output_override_enabled = False
+        # the boards are updated from other threads, redraw in this one
+        for board in self.emulator.boards:
+            board.update_callbacks.append(self.mark_dirty)
+        self.frame_timer = QtCore.QTimer(self)
+        self.frame_timer.timeout.connect(self.update_emulator)
+        self.frame_timer.start(int(1000 / frame_rate))
+
+    @property
+    def LNdigital(self):
+        return self.board.LNdigital
+
+    @property
+    def input_state(self):
+        return self.board.input_state
 
+    @property
+    def output_state(self):
+        return self.board.output_state
+
+    @property
+    def output_override_enabled(self):
+        return self.board.output_override_enabled
 
     def address0ActionToggled(self):
         self._addressActionToggled(0)
@@ -255,8 +271,7 @@ class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
 
     def _addressActionToggled(self, index):
         self.current_LN = index
-        if self.LNdigital:
-            self.LNdigital.hardware_addr = index
+        self.board = self.emulator.boards[index]
         # block the signals
         self.address0Action.blockSignals(True)
         self.address1Action.blockSignals(True)
@@ -272,7 +287,8 @@ class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
         self.address1Action.blockSignals(False)
         self.address2Action.blockSignals(False)
         self.address3Action.blockSignals(False)
-        self.update_emulator()
+        self.update_output_control()
+        self.mark_dirty()
 
     def set_led_label_locations(self):
         """Sets the location of the LED on image labels."""
@@ -285,103 +301,69 @@ class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
             led_label.raise_()
 
     def enable_output_control(self, enable):
+        self.board.enable_output_override(enable)
         if enable:
-            self._saved_output_state = list(self.output_state)
             self.update_all_output_buttons()
         else:
-            self.output_state = self._saved_output_state
             self.uncheck_all_output_buttons()
-            self.update_emulator()
 
-        self.output_override_enabled = enable
         self.outputControlBox.setEnabled(enable)
 
+    def update_output_control(self):
+        """Shows the output override state of the current board."""
+        enabled = self.output_override_enabled
+        self.outputControlAction.blockSignals(True)
+        self.outputControlAction.setChecked(enabled)
+        self.outputControlAction.blockSignals(False)
+        self.outputControlBox.setEnabled(enabled)
+        for i, button in enumerate(self.output_buttons):
+            button.blockSignals(True)
+            button.setChecked(enabled and self.output_state[i])
+            button.blockSignals(False)
+
     def set_input_pullups(self, enable):
-        if self.LNdigital is not None:
-            self.LNdigital.gppub.value = 0xff if enable else 0x00
-            if not enable:
-                for i, s in enumerate(self.input_state):
-                    self.set_input(i, False)
-                self.update_emulator()
+        self.board.set_input_pullups(enable)
 
     def output_overide(self, enable):
         """sets the output to mirror the override buttons"""
         # find out output override buttons state
         # then write them to the output
         # don't use set_output since that is locked when override mode is on
-        for i, button in enumerate(self.output_buttons):
-            self.output_state[i] = button.isChecked()
-        self.update_emulator()
-
-    def set_output(self, index, enable, hardware_addr=None):
-        """Sets the specified output on or off"""
-        if not self.output_override_enabled:
-            self.output_state[index] = enable
+        self.board.set_output_override(
+            [button.isChecked() for button in self.output_buttons])
 
-    def set_input(self, index, enable, hardware_addr=None):
-        # don't set the input if it is being held
-        if not self.circleDrawingWidget.input_hold[index]:
-            self.input_state[index] = enable
-
-    def get_output_as_value(self):
-        output_value = 0
-        for bit_index, state in enumerate(self.output_state):
-            this_bit = 1 if state else 0
-            output_value |= (this_bit << bit_index)
-        return output_value
-
-    def update_LN(self):
-        self.LNdigital.output_port.value = self.get_output_as_value()
-
-    interrupt_flagger = Signal(int)
+    def mark_dirty(self, board=None):
+        """Marks the view for redrawing, can be called from any thread."""
+        if board is None or board is self.board:
+            self.view_dirty = True
 
+    @Slot()
     def update_emulator(self):
+        """Redraws the view if the board has changed since the last frame."""
+        if not self.view_dirty:
+            return
+        self.view_dirty = False
         self.update_circles()
-        if self.input_has_changed():
-            pin, direction = self.get_changed_pin_and_direction()
-            self.interrupt_flagger.emit(
-                small_nums_to_single_val(pin, direction))
-        self.previous_input_state = list(self.input_state)
         self.update_led_images()
 
-        if self.LNdigital is not None:
-            self.update_LN()
-
-    def input_has_changed(self):
-        return self.input_state != self.previous_input_state
-
-    def get_changed_pin_and_direction(self):
-        for i, x in enumerate(
-                zip(self.input_state, self.previous_input_state)):
-            if x[0] != x[1]:
-                pin = i
-                direction = LNdigitalIO.IODIR_ON \
-                    if x[0] else LNdigitalIO.IODIR_OFF
-                return pin, direction
-
     def update_circles(self):
-        self.circleDrawingWidget.input_pin_circles_state = self.input_state
-        self.circleDrawingWidget.output_pin_circles_state = self.output_state
-        self.circleDrawingWidget.repaint()
+        self.circleDrawingWidget.update()
 
     def update_led_images(self):
         for index, state in enumerate(self.output_state):
             self.led_labels[index].setVisible(state)
 
     def all_outputs_on(self):
-        self.output_state = [True for s in range(8)]
+        self.board.all_outputs_on()
         self.update_all_output_buttons()
-        self.update_emulator()
 
     def all_outputs_off(self):
-        self.output_state = [False for s in range(8)]
+        self.board.all_outputs_off()
         self.update_all_output_buttons()
-        self.update_emulator()
 
     def all_outputs_toggle(self):
-        self.output_state = [not s for s in self.output_state]
+        self.board.all_outputs_toggle()
         self.update_all_output_buttons()
-        self.update_emulator()
 
     def uncheck_all_output_buttons(self):
         for button in self.output_buttons:
@@ -395,154 +377,19 @@ class LNdigitalEmulatorWindow(QMainWindow, Ui_LN_DigitalEmulatorWindow):
             button.setChecked(self.output_state[i])
             button.toggled.connect(self.output_overide)
 
-    @Slot(int)
-    def set_input_enable(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        self.set_input(pin_num, True, hardware_addr)
-        self.update_emulator()
-
-    @Slot(int)
-    def set_input_disable(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        self.set_input(pin_num, False, hardware_addr)
-        self.update_emulator()
-
-    @Slot(int)
-    def set_output_enable(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        self.set_output(pin_num, True, hardware_addr)
-        self.update_emulator()
-
-    @Slot(int)
-    def set_output_disable(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        self.set_output(pin_num, False, hardware_addr)
-        self.update_emulator()
-
-    send_input = Signal(int)
-
-    @Slot(int)
-    def get_input(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        input_on = 1 if self.input_state[pin_num] else 0
-        send_val = small_nums_to_single_val(input_on, hardware_addr)
-        self.send_input.emit(send_val)
-
-    send_output = Signal(int)
-
-    @Slot(int)
-    def get_output(self, value):
-        pin_num, hardware_addr = single_val_to_small_nums(value)
-        pin_on = 1 if self.output_state[pin_num] else 0
-        send_val = small_nums_to_single_val(pin_on, hardware_addr)
-        self.send_output.emit(send_val)
-
-
-class QueueWatcher(QObject):
-    """Handles the queue which talks to the main process"""
-
-    set_out_enable = Signal(int)
-    set_out_disable = Signal(int)
-    get_in = Signal(int)
-    get_out = Signal(int)
-
-    def __init__(self, app, emu_window, q_to_em, q_from_em):
-        super().__init__()
-        self.main_app = app
-        self.emu_window = emu_window
-        self.q_to_em = q_to_em
-        self.q_from_em = q_from_em
-        self.perform = {
-            'set_out': self.set_out_pin,
-            'get_in': self.get_in_pin,
-            'get_out': self.get_out_pin,
-            'register_interrupt': self.register_interrupt,
-            'activate_interrupt': self.activate_interrupt,
-            'deactivate_interrupt': self.deactivate_interrupt,
-            'quit': self.quit_main_app,
-        }
-        self.pin_function_maps = list()
-        self.interrupts_activated = False
-
-    def check_queue(self):
-        while True:
-            action = self.q_to_em.get(block=True)
-            task = action[0]
-            self.perform[task](action[1:])
-
-    def set_out_pin(self, data):
-        pin, enable, hardware_addr = data
-        if enable:
-            self.set_out_enable.emit(
-                small_nums_to_single_val(pin, hardware_addr))
-        else:
-            self.set_out_disable.emit(
-                small_nums_to_single_val(pin, hardware_addr))
-
-    def get_in_pin(self, data):
-        pin, hardware_addr = data[0], data[1]
-        self.get_in.emit(small_nums_to_single_val(pin, hardware_addr))
-        # now we have to rely on the emulator getting back to us
-
-    @Slot(int)
-    def send_get_in_pin_result(self, value):
-        value, hardware_addr = single_val_to_small_nums(value)
-        self.q_from_em.put(value)
-
-    def get_out_pin(self, data):
-        pin, hardware_addr = data[0], data[1]
-        self.get_out.emit(small_nums_to_single_val(pin, hardware_addr))
-
-    @Slot(int)
-    def send_get_out_pin_result(self, value):
-        value, hardware_addr = single_val_to_small_nums(value)
-        self.q_from_em.put(value)
-
-    def register_interrupt(self, data):
-        pin_num, direction, callback = data
-        self.pin_function_maps.append(LNcommon.interrupts.PinFunctionMap(
-            pin_num, direction, callback))
-
-    def activate_interrupt(self, data):
-        self.interrupts_activated = True
-
-    def deactivate_interrupt(self, data):
-        self.interrupts_activated = False
-
-    @Slot(int)
-    def handle_interrupt(self, data):
-        pin, direction = single_val_to_small_nums(data)
-        func = self.get_registered_interrupt_func(pin, direction)
-        if func is not None:
-            flag = 0xff ^ LNcommon.get_bit_mask(pin)
-            capture = self.emu_window.get_output_as_value()
-            func(LNcommon.InterruptEvent(flag, capture))
-
-    def get_registered_interrupt_func(self, pin, direction):
-        for funcmap in self.pin_function_maps:
-            if funcmap.pin_num == pin and funcmap.direction == direction:
-                return funcmap.callback
-        else:
-            return None
-
-    def quit_main_app(self, data):
-        self.main_app.quit()
-
 
 class InputWatcher(QObject):
     """Handles inputs and changes the emulator accordingly"""
 
-    set_in_enable = Signal(int)
-    set_in_disable = Signal(int)
-
-    def __init__(self, emu_window):
+    def __init__(self, emulator):
         super().__init__()
-        self.emu_window = emu_window
-        cap = emu_window.LNdigital.intcapb.value  # clear interrupt
+        self.boards = emulator.boards
         self.event_listeners = list()
-        for i in range(NUM_LN_DIGITALS):
-            listener = LNdigitalIO.InputEventListener(
-                emu_window.LNdigital)
+        for board in self.boards:
+            if board.LNdigital is None:
+                continue
+            cap = board.LNdigital.intcapb.value  # clear interrupt
+            listener = LNdigitalIO.InputEventListener(board.LNdigital)
             for i in range(8):
                 listener.register(
                     i, LNdigitalIO.IODIR_BOTH, self.set_input)
@@ -557,14 +404,15 @@ class InputWatcher(QObject):
             listener.deactivate()
 
     def set_input(self, event):
-        if event.direction == LNdigitalIO.IODIR_OFF:
-            self.set_in_disable.emit(
-                small_nums_to_single_val(event.pin_num,
-                                         event.chip.hardware_addr))
-        else:
-            self.set_in_enable.emit(
-                small_nums_to_single_val(event.pin_num,
-                                         event.chip.hardware_addr))
+        board = self.boards[event.chip.hardware_addr]
+        with board.lock:
+            # the flag can have more than one pin in it
+            for pin_num in range(8):
+                if (event.interrupt_flag >> pin_num) & 1:
+                    board.set_input(
+                        pin_num,
+                        not (event.interrupt_capture >> pin_num) & 1)
+            board.update()
 
 
 def get_input_index_from_mouse(point, LNdig_ver):
@@ -595,45 +443,12 @@ def get_input_index_from_mouse(point, LNdig_ver):
     return (None, False)  # no pin found, press did not occur on switch
 
 
-def start_q_watcher(app, emu_window, proc_comms_q_to_em, proc_comms_q_from_em):
-    # need to spawn a worker thread that watches the proc_comms_q
-    # need to seperate queue function from queue thread
-    # http://stackoverflow.com/questions/4323678/threading-and-signals-problem
-    # -in-pyqt
-    q_watcher = QueueWatcher(
-        app, emu_window, proc_comms_q_to_em, proc_comms_q_from_em)
-    q_watcher_thread = QThread()
-    q_watcher.moveToThread(q_watcher_thread)
-    q_watcher_thread.started.connect(q_watcher.check_queue)
-
-    # now that we've set up the thread, let's set up rest of signals/slots
-    q_watcher.set_out_enable.connect(emu_window.set_output_enable)
-    q_watcher.set_out_disable.connect(emu_window.set_output_disable)
-    q_watcher.get_in.connect(emu_window.get_input)
-    q_watcher.get_out.connect(emu_window.get_output)
-
-    emu_window.send_output.connect(q_watcher.send_get_out_pin_result)
-    emu_window.send_input.connect(q_watcher.send_get_in_pin_result)
-    emu_window.interrupt_flagger.connect(q_watcher.handle_interrupt)
-
-    # not sure why this doesn't work by connecting to q_watcher_thread.quit
-    def about_to_quit():
-        q_watcher_thread.quit()
-    app.aboutToQuit.connect(about_to_quit)
-
-    q_watcher_thread.start()
-
-
-def start_input_watcher(app, emu_window):
-    input_watcher = InputWatcher(emu_window)
+def start_input_watcher(app, emulator):
+    input_watcher = InputWatcher(emulator)
     input_watcher_thread = QThread()
     input_watcher.moveToThread(input_watcher_thread)
     input_watcher_thread.started.connect(input_watcher.check_inputs)
 
-    # signal / slots
-    input_watcher.set_in_enable.connect(emu_window.set_input_enable)
-    input_watcher.set_in_disable.connect(emu_window.set_input_disable)
-
     # quit setup
     def about_to_quit():
         input_watcher.stop_checking_inputs()
@@ -646,39 +461,53 @@ def start_input_watcher(app, emu_window):
 def run_emulator(
         sysargv,
         use_LNdigital,
-        init_board,
-        emulated_LN):
+        hardware_addr,
+        bus,
+        chip_select,
+        connection,
+        authkey,
+        frame_rate=DEFAULT_FRAME_RATE,
+        record=None,
+        address=None):
     app = QApplication(sysargv)
 
-    emu_window = LNdigitalEmulatorWindow()
-
+    LNdigital = None
     if use_LNdigital:
-        emu_window.LNdigital = LNdigitalIO.LNdigitals(
-            hardware_addr=emulated_LN.hardware_addr,
-            bus=emulated_LN.bus,
-            chip_select=emulated_LN.chip_select,
-            init_board=init_board)
-
-    emu_window.current_LN = emulated_LN.hardware_addr
-
-    start_q_watcher(app,
-                    emu_window,
-                    emulated_LN.proc_comms_q_to_em,
-                    emulated_LN.proc_comms_q_from_em)
+        LNdigital = LNdigitalIO.LNdigitals(
+            hardware_addr=hardware_addr,
+            bus=bus,
+            chip_select=chip_select,
+            init_board=False)  # the process that started us did
+
+    pin_state = create_pin_state()
+    emulator = EmulatorEngine(LNdigital, pin_state.buf)
+    recorder = None
+    if record is not None:
+        recorder = Recorder.open(emulator, record)
+
+    emu_window = LNdigitalEmulatorWindow(emulator, frame_rate=frame_rate)
+    emu_window._addressActionToggled(hardware_addr)
+
+    # the server's threads can't call the app directly
+    def quit_main_app():
+        QtCore.QMetaObject.invokeMethod(app, "quit", Qt.QueuedConnection)
+
+    server = EmulatorServer(emulator,
+                            pin_state.name,
+                            address,
+                            authkey,
+                            on_quit=quit_main_app)
+    server.start(connection)
 
     # only watch inputs if there is actually a LN digital
-    if emu_window.LNdigital is not None:
-        start_input_watcher(app, emu_window)
+    if LNdigital is not None:
+        start_input_watcher(app, emulator)
 
     emu_window.show()
-    app.exec_()
-
-
-def small_nums_to_single_val(val1, val2):
-    return (val1 << 4) ^ val2
-
-
-def single_val_to_small_nums(singleval):
-    val2 = singleval & 0xf
-    val1 = singleval >> 4
-    return val1, val2
+    try:
+        app.exec_()
+    finally:
+        server.close()
+        if recorder is not None:
+            recorder.close()
+        pin_state.unlink()
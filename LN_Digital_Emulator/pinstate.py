@@ -0,0 +1,53 @@
+"""Pin state of the emulated LN Digitals, shared between the emulator process
+and LNdigitals so that reads do not have to go through the emulator.
+"""
+from multiprocessing import resource_tracker, shared_memory
+
+
+NUM_LN_DIGITALS = 4
+
+# byte offsets in each board's part of the block, one bit per pin
+INPUT_STATE_OFFSET = 0
+OUTPUT_STATE_OFFSET = 1
+BOARD_STATE_SIZE = 2
+PIN_STATE_SIZE = NUM_LN_DIGITALS * BOARD_STATE_SIZE
+
+# what changed the outputs: a client of the emulator, the GUI's override
+# buttons, or its all on, all off and flip buttons
+OUTPUT_SOURCES = ('client', 'override', 'all_on', 'all_off', 'flip')
+
+
+def create_pin_state():
+    """Returns a new, zeroed shared memory block for the pin state."""
+    pin_state = shared_memory.SharedMemory(create=True, size=PIN_STATE_SIZE)
+    pin_state.buf[:PIN_STATE_SIZE] = bytes(PIN_STATE_SIZE)
+    return pin_state
+
+
+def attach_pin_state(name):
+    """Returns the shared memory block created by create_pin_state."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching registers the block with this
+        # process's resource tracker, which would remove it on exit
+        pin_state = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(pin_state._name, 'shared_memory')
+        return pin_state
+
+
+def input_state_offset(hardware_addr):
+    return hardware_addr * BOARD_STATE_SIZE + INPUT_STATE_OFFSET
+
+
+def output_state_offset(hardware_addr):
+    return hardware_addr * BOARD_STATE_SIZE + OUTPUT_STATE_OFFSET
+
+
+def states_to_value(states):
+    """Returns a list of eight booleans as a port value."""
+    value = 0
+    for bit_index, state in enumerate(states):
+        if state:
+            value |= 1 << bit_index
+    return value
@@ -0,0 +1,188 @@
+"""The messages sent between LNdigitals and the emulator process.
+
+Every message is a small fixed size struct sent with send_bytes(), nothing
+is pickled. A request is ``(opcode, hardware_addr, arg0, arg1, request_id)``
+where the args are a task's arguments (pin, mask, value, port); a reply is
+``(request_id, kind, value)`` followed by a payload for the odd result that
+isn't a number (or an error, with its exception type and message); an
+input event is ``(hardware_addr, flag, capture,
+timestamp)`` and an output event ``(hardware_addr, old_value, new_value,
+timestamp, source)``.
+"""
+import builtins
+import json
+import struct
+from .pinstate import OUTPUT_SOURCES
+
+
+# request_id of a request that wants no reply
+NO_REPLY = 0xffffffff
+
+REQUEST = struct.Struct("<BBBBI")
+REPLY = struct.Struct("<IBi")
+EVENT = struct.Struct("<BBBd")
+OUTPUT_EVENT = struct.Struct("<BBBdB")
+
+# task: (opcode, number of args, whether the last arg is a hardware_addr)
+TASKS = {
+    'set_out': (1, 2, True),
+    'get_in': (2, 1, True),
+    'get_out': (3, 1, True),
+    'set_port': (4, 2, True),
+    'get_port': (5, 1, True),
+    'set_masked': (6, 2, True),
+    'sync': (7, 0, False),
+    'hello': (8, 0, False),
+    'quit': (9, 0, False),
+    'events': (10, 0, False),
+    'toggle_masked': (11, 1, True),
+    'set_in_port': (12, 1, True),
+    'set_in': (13, 2, True),
+    'stats': (14, 0, False),
+    'output_events': (15, 0, False),
+}
+OPCODES = {opcode: (task, num_args, has_hardware_addr)
+           for task, (opcode, num_args, has_hardware_addr) in TASKS.items()}
+
+RESULT_NONE = 0
+RESULT_INT = 1
+RESULT_STR = 2
+RESULT_JSON = 3
+RESULT_ERROR = 4
+
+
+class BadRequest(ValueError):
+    """A request that can't be decoded. request_id is its id, None if it
+    doesn't want a reply or couldn't be read.
+    """
+    def __init__(self, message, request_id=None):
+        super(BadRequest, self).__init__(message)
+        self.request_id = request_id
+
+
+def request_ids():
+    """Yields request ids for a connection, forever. They wrap round to 0
+    before NO_REPLY, so long running clients never send an id that means
+    no reply or doesn't fit.
+    """
+    while True:
+        yield from range(NO_REPLY)
+
+
+def action_to_fields(action):
+    """Returns ``(opcode, hardware_addr, arg0, arg1)`` for
+    ``(task, *args)``. Args that don't fit in a byte raise struct.error
+    (when packed) rather than being truncated.
+    """
+    opcode, num_args, has_hardware_addr = TASKS[action[0]]
+    args = action[1:num_args+1] + (0, 0)
+    hardware_addr = action[-1] if has_hardware_addr else 0
+    return opcode, hardware_addr, args[0], args[1]
+
+
+def fields_to_action(opcode, hardware_addr, arg0, arg1):
+    task, num_args, has_hardware_addr = OPCODES[opcode]
+    action = (task,) + (arg0, arg1)[:num_args]
+    if has_hardware_addr:
+        action += (hardware_addr,)
+    return action
+
+
+def encode_request(request_id, action):
+    if request_id is None:
+        request_id = NO_REPLY
+    return REQUEST.pack(*action_to_fields(action), request_id)
+
+
+def decode_request(data):
+    """Returns ``(request_id, action)``. Raises BadRequest if data isn't
+    a request this version knows.
+    """
+    if len(data) != REQUEST.size:
+        raise BadRequest("A request is {} bytes, not {}.".format(
+            REQUEST.size, len(data)))
+    opcode, hardware_addr, arg0, arg1, request_id = REQUEST.unpack(data)
+    if request_id == NO_REPLY:
+        request_id = None
+    if opcode not in OPCODES:
+        raise BadRequest("Unknown opcode {}.".format(opcode), request_id)
+    return request_id, fields_to_action(opcode, hardware_addr, arg0, arg1)
+
+
+def encode_reply(request_id, result):
+    """result can be an exception, which is sent as the nearest built in
+    exception type and its message.
+    """
+    if request_id is None:
+        request_id = NO_REPLY
+    payload = b''
+    if isinstance(result, Exception):
+        error_type = next(error_type for error_type in type(result).__mro__
+                          if getattr(builtins, error_type.__name__, None)
+                          is error_type)
+        kind, value = RESULT_ERROR, 0
+        payload = json.dumps([error_type.__name__, str(result)]).encode(
+            'utf-8')
+    elif result is None:
+        kind, value = RESULT_NONE, 0
+    elif isinstance(result, int):
+        kind, value = RESULT_INT, result
+    elif isinstance(result, str):
+        kind, value = RESULT_STR, 0
+        payload = result.encode('utf-8')
+    else:
+        kind, value = RESULT_JSON, 0
+        payload = json.dumps(result).encode('utf-8')
+    return REPLY.pack(request_id, kind, value) + payload
+
+
+def decode_reply(data):
+    """Returns ``(request_id, result)``, result is an exception if the
+    request failed.
+    """
+    request_id, kind, value = REPLY.unpack_from(data)
+    if request_id == NO_REPLY:
+        request_id = None
+    if kind == RESULT_NONE:
+        return request_id, None
+    elif kind == RESULT_INT:
+        return request_id, value
+    payload = bytes(data[REPLY.size:]).decode('utf-8')
+    if kind == RESULT_STR:
+        return request_id, payload
+    elif kind == RESULT_ERROR:
+        error_name, message = json.loads(payload)
+        error_type = getattr(builtins, error_name, None)
+        if not (isinstance(error_type, type) and
+                issubclass(error_type, Exception)):
+            error_type = RuntimeError
+        return request_id, error_type(message)
+    else:
+        return request_id, json.loads(payload)
+
+
+def encode_event(event):
+    return EVENT.pack(*event)
+
+
+def decode_event(data):
+    return EVENT.unpack(data)
+
+
+def encode_output_event(event):
+    hardware_addr, old_value, new_value, timestamp, source = event
+    return OUTPUT_EVENT.pack(hardware_addr,
+                             old_value,
+                             new_value,
+                             timestamp,
+                             OUTPUT_SOURCES.index(source))
+
+
+def decode_output_event(data):
+    hardware_addr, old_value, new_value, timestamp, source = \
+        OUTPUT_EVENT.unpack(data)
+    return (hardware_addr,
+            old_value,
+            new_value,
+            timestamp,
+            OUTPUT_SOURCES[source])
@@ -0,0 +1,123 @@
+"""Recording an emulator's traffic to a log, and replaying the input changes
+in a log.
+
+A log is LOG_HEADER followed by fixed size records of ``(timestamp, opcode,
+hardware_addr, arg0, arg1)``, timestamps from the engine clock's
+monotonic(). Requests are recorded with their protocol opcode and args,
+input changes as INPUT_CHANGE with the new value of the input port and the
+pins that changed. Inputs read from the shared pin state never reach the
+emulator so they aren't recorded.
+"""
+import struct
+import threading
+from .clock import REAL_CLOCK
+from .protocol import action_to_fields, fields_to_action
+
+
+LOG_HEADER = b'LNDLOG1\n'
+RECORD = struct.Struct("<dBBBB")
+# not a protocol opcode
+INPUT_CHANGE = 0
+
+
+class Recorder(object):
+    """Appends the requests an EmulatorEngine handles and the changes to
+    its inputs to log_file (opened for binary writing).
+
+    The log is flushed every flush_interval seconds, so little is lost if
+    the process is killed.
+    """
+    flush_interval = 1.0
+
+    def __init__(self, engine, log_file):
+        self.engine = engine
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if log_file.tell() == 0:
+            log_file.write(LOG_HEADER)
+        engine.request_callbacks.append(self.record_request)
+        engine.event_callbacks.append(self.record_event)
+        thread = threading.Thread(target=self.flush_periodically)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def open(cls, engine, file_name):
+        """Records to file_name, adding to the end if it already exists."""
+        return cls(engine, open(file_name, 'ab'))
+
+    def record_request(self, action):
+        self.write(action_to_fields(action))
+
+    def record_event(self, event):
+        hardware_addr, flag, capture, timestamp = event
+        self.write((INPUT_CHANGE, hardware_addr, 0xff ^ capture, flag))
+
+    def write(self, fields):
+        record = RECORD.pack(self.engine.clock.monotonic(), *fields)
+        with self.lock:
+            if not self.log_file.closed:
+                self.log_file.write(record)
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            with self.lock:
+                if not self.log_file.closed:
+                    self.log_file.flush()
+
+    def close(self):
+        if self.log_file.closed:
+            return
+        self.engine.request_callbacks.remove(self.record_request)
+        self.engine.event_callbacks.remove(self.record_event)
+        self.stopped.set()
+        with self.lock:
+            self.log_file.close()
+
+
+def read_log(file_name):
+    """Yields ``(timestamp, action)`` for every record in a log. Input
+    changes are ``('input', value, changed_pins, hardware_addr)``.
+    """
+    with open(file_name, 'rb') as log_file:
+        if log_file.read(len(LOG_HEADER)) != LOG_HEADER:
+            raise ValueError("%s is not an emulator log" % file_name)
+        while True:
+            record = log_file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, opcode, hardware_addr, arg0, arg1 = \
+                RECORD.unpack(record)
+            if opcode == INPUT_CHANGE:
+                yield timestamp, ('input', arg0, arg1, hardware_addr)
+            else:
+                yield timestamp, fields_to_action(
+                    opcode, hardware_addr, arg0, arg1)
+
+
+def replay(file_name, emulator_connection, speed=1.0, clock=REAL_CLOCK):
+    """Sets the emulator's inputs as they changed in a log. speed is how
+    much faster than recorded to go (2.0 is twice as fast), or None to go
+    as fast as possible. The waits between changes are slept on clock.
+
+    Returns the number of input changes, once they have all been applied.
+    """
+    start = None
+    num_changes = 0
+    for timestamp, action in read_log(file_name):
+        if action[0] != 'input':
+            continue
+        task, value, changed_pins, hardware_addr = action
+        if speed is not None:
+            if start is None:
+                start = (timestamp, clock.monotonic())
+            else:
+                delay = (start[1] + (timestamp - start[0]) / speed -
+                         clock.monotonic())
+                if delay > 0:
+                    clock.sleep(delay)
+        emulator_connection.send(('set_in_port', value, hardware_addr))
+        num_changes += 1
+    emulator_connection.request(('sync',))
+    return num_changes
@@ -0,0 +1,347 @@
+"""Serves an EmulatorEngine to LNdigitals in other processes, or on other
+machines.
+"""
+import collections
+import os
+import queue
+import sys
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+import LNdigitalIO
+from .engine import EmulatorEngine, EventQueue
+from .pinstate import NUM_LN_DIGITALS, create_pin_state
+from .record import Recorder
+from .protocol import (
+    BadRequest,
+    decode_request,
+    encode_event,
+    encode_output_event,
+    encode_reply,
+    TASKS,
+)
+
+
+# the shared secret of emulator servers and their clients
+AUTHKEY_ENV = 'LN_DIGITAL_EMULATOR_AUTHKEY'
+
+
+class FairScheduler(object):
+    """Runs requests, taking turns between clients so that a busy client
+    can't starve the others.
+
+    Every client has its own queue of requests, which are run one at a
+    time in order. The scheduler takes one request from each client that
+    has any, round robin. There is a thread for each board so requests for
+    different boards (from different clients) run at the same time, but a
+    board only has one request running at once. A client with max_queued
+    requests waiting has to wait to add more, which holds up reading from
+    its connection.
+    """
+    max_queued = 1024
+
+    def __init__(self, handle, num_workers=NUM_LN_DIGITALS):
+        self.handle = handle
+        # clients with requests waiting and none running, in the order they
+        # get their turn
+        self.ready = collections.deque()
+        # id()s of the clients with a request running
+        self.running = set()
+        self.busy_boards = set()
+        self.changed = threading.Condition()
+        self.num_queued = 0
+        for i in range(num_workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, client_requests, request, reply):
+        """Queues request for client_requests (a deque for each client),
+        reply is called with the result, or the exception if it fails.
+        """
+        with self.changed:
+            while len(client_requests) >= self.max_queued:
+                self.changed.wait()
+            if (not client_requests and
+                    id(client_requests) not in self.running):
+                self.ready.append(client_requests)
+            client_requests.append((request, reply))
+            self.num_queued += 1
+            self.changed.notify_all()
+
+    def run(self):
+        while True:
+            with self.changed:
+                while True:
+                    client_requests, board = self._next_client()
+                    if client_requests is not None:
+                        break
+                    self.changed.wait()
+                request, reply = client_requests.popleft()
+                self.running.add(id(client_requests))
+                if board is not None:
+                    self.busy_boards.add(board)
+                self.num_queued -= 1
+                self.changed.notify_all()
+            try:
+                result = self.handle(request)
+            except Exception as error:
+                result = error  # the client gets it, the worker carries on
+            reply(result)
+            with self.changed:
+                self.running.remove(id(client_requests))
+                self.busy_boards.discard(board)
+                if client_requests:
+                    # to the back of the line
+                    self.ready.append(client_requests)
+                self.changed.notify_all()
+
+    def _next_client(self):
+        """Takes the first ready client whose next request's board is free,
+        returns it and the board, or (None, None).
+        """
+        for client_requests in self.ready:
+            board = _board(client_requests[0][0])
+            if board is None or board not in self.busy_boards:
+                self.ready.remove(client_requests)
+                return client_requests, board
+        return None, None
+
+
+def _board(request):
+    """Returns the hardware_addr of request, or None if it isn't for a
+    board.
+    """
+    num_args, has_hardware_addr = TASKS[request[0]][1:]
+    return request[-1] if has_hardware_addr else None
+
+
+class EmulatorServer(object):
+    """Listens for LNdigitals connecting to the emulator and serves any
+    number of them, in other processes or on other machines.
+
+    Each connection is read by its own thread and its requests (see
+    protocol) are run by a FairScheduler, answered (from another thread of
+    the connection's) unless their request_id is None. As well as the
+    engine's tasks the server handles ``hello``, which replies with the
+    name of the shared pin state, and ``quit``. A connection that sends
+    ``events`` becomes an event channel: it is sent a reply once it is
+    subscribed, then the engine's input events are streamed to it and it
+    makes no requests. ``output_events`` does the same with the engine's
+    output events.
+    """
+    # replies a connection can have waiting to be sent before the server
+    # stops reading its requests
+    max_unsent_replies = 1024
+    # events an event channel can have waiting to be sent before the oldest
+    # are dropped
+    max_queued_events = 1024
+    # how each kind of event channel's events are sent
+    event_encoders = {'events': encode_event,
+                      'output_events': encode_output_event}
+
+    def __init__(self,
+                 emulator,
+                 pin_state_name,
+                 address=None,
+                 authkey=None,
+                 on_quit=None):
+        self.emulator = emulator
+        self.pin_state_name = pin_state_name
+        self.on_quit = on_quit
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        # the queues of the event channels, by kind
+        self.event_queues = {kind: list() for kind in self.event_encoders}
+        self.event_queues_lock = threading.Lock()
+        self.scheduler = FairScheduler(self.handle)
+        emulator.event_callbacks.append(self.send_event)
+        emulator.output_event_callbacks.append(self.send_output_event)
+        emulator.stats.gauges['event_queue_depth'] = self.event_queue_depth
+        emulator.stats.gauges['request_queue_depth'] = \
+            lambda: self.scheduler.num_queued
+
+    def start(self, connection=None):
+        """Starts serving in the background. connection is an already open
+        connection (from the process that started the emulator), it is
+        told the server's address once the server is ready.
+        """
+        self._start_thread(self.accept_connections)
+        if connection is not None:
+            connection.send_bytes(
+                encode_reply(None, [self.address, self.pin_state_name]))
+            self._start_thread(self.serve_connection, connection)
+
+    def close(self):
+        self.listener.close()
+
+    def accept_connections(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                return  # the listener has been closed
+            self._start_thread(self.serve_connection, connection)
+
+    def serve_connection(self, connection):
+        requests = collections.deque()
+        # replies are sent by their own thread so that a client that
+        # doesn't read them only holds up itself
+        replies = queue.Queue()
+        unsent_replies = threading.Semaphore(self.max_unsent_replies)
+        sender = self._start_thread(
+            self.send_replies, connection, replies, unsent_replies)
+
+        def reply_to(request_id):
+            def reply(result):
+                if request_id is not None:
+                    replies.put((request_id, result))
+            return reply
+
+        while True:
+            try:
+                request_id, action = decode_request(connection.recv_bytes())
+            except (EOFError, OSError):
+                break
+            except BadRequest as error:
+                if error.request_id is not None:
+                    unsent_replies.acquire()
+                    replies.put((error.request_id, error))
+                continue
+            if action[0] in self.event_encoders:
+                replies.put(None)
+                self.stream_events(connection, action[0])
+                return
+            if request_id is not None:
+                unsent_replies.acquire()
+            self.scheduler.submit(requests, action, reply_to(request_id))
+        # let the requests still queued finish before closing
+        self.scheduler.submit(requests, ('sync',), lambda result:
+                              replies.put(None))
+        sender.join()
+        connection.close()
+
+    def send_replies(self, connection, replies, unsent_replies):
+        """Sends the replies put in replies until it is given None."""
+        while True:
+            reply = replies.get()
+            if reply is None:
+                break
+            try:
+                connection.send_bytes(encode_reply(*reply))
+            except OSError:
+                pass  # the client has gone
+            unsent_replies.release()
+
+    def handle(self, action):
+        task = action[0]
+        if task == 'hello':
+            return self.pin_state_name
+        elif task == 'quit':
+            if self.on_quit is not None:
+                self.on_quit()
+        else:
+            return self.emulator.handle(action)
+
+    def send_event(self, event, kind='events'):
+        # the connections are written to by their own threads so that a
+        # slow client doesn't hold up the board
+        with self.event_queues_lock:
+            for event_queue in self.event_queues[kind]:
+                event_queue.put(event)
+
+    def send_output_event(self, event):
+        self.send_event(event, 'output_events')
+
+    def event_queue_depth(self):
+        """Returns the most events waiting to be sent to one connection."""
+        with self.event_queues_lock:
+            return max([event_queue.qsize()
+                        for event_queues in self.event_queues.values()
+                        for event_queue in event_queues] or [0])
+
+    def stream_events(self, connection, kind='events'):
+        encode = self.event_encoders[kind]
+        event_queue = EventQueue(self.max_queued_events, self.emulator.stats)
+        with self.event_queues_lock:
+            self.event_queues[kind].append(event_queue)
+        try:
+            connection.send_bytes(encode_reply(None, True))
+            while True:
+                connection.send_bytes(encode(event_queue.get()))
+        except OSError:
+            pass  # the client has gone
+        finally:
+            with self.event_queues_lock:
+                self.event_queues[kind].remove(event_queue)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def default_authkey():
+    """Returns the authkey in the LN_DIGITAL_EMULATOR_AUTHKEY environment
+    variable, or None.
+    """
+    authkey = os.environ.get(AUTHKEY_ENV)
+    return None if authkey is None else authkey.encode('utf-8')
+
+
+def parse_address(address):
+    """Returns the Listener/Client address for 'host:port' (TCP) or a
+    path (Unix socket).
+    """
+    if isinstance(address, str) and ':' in address and \
+            not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+def serve(address, authkey=None, gui=False, record=None, frame_rate=60):
+    """Runs an emulator that serves any number of LNdigitals (see
+    core.RemoteLNdigitals) at address, a 'host:port' or a Unix socket path,
+    until it is sent quit or interrupted. Without an authkey anyone who can
+    connect can use it. With gui=True it shows the GUI too.
+    """
+    address = parse_address(address)
+    if gui:
+        from .gui import run_emulator
+        run_emulator(sys.argv,
+                     False,
+                     0,
+                     LNdigitalIO.DEFAULT_SPI_BUS,
+                     LNdigitalIO.DEFAULT_SPI_CHIP_SELECT,
+                     None,
+                     authkey,
+                     frame_rate,
+                     record,
+                     address)
+        return
+
+    pin_state = create_pin_state()
+    engine = EmulatorEngine(None, pin_state.buf)
+    recorder = None
+    if record is not None:
+        recorder = Recorder.open(engine, record)
+    quit = threading.Event()
+    server = EmulatorServer(
+        engine, pin_state.name, address, authkey, on_quit=quit.set)
+    server.start()
+    print("LN Digital emulator serving at", server.address)
+    try:
+        # wait with a timeout so that KeyboardInterrupt gets through
+        while not quit.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if recorder is not None:
+            recorder.close()
+        pin_state.unlink()
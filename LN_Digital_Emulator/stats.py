@@ -0,0 +1,87 @@
+"""Counters and latency histograms kept by the emulator and its clients, so
+you can see where the time is going.
+"""
+import json
+import threading
+import time
+
+
+class Histogram(object):
+    """Counts of times in power of two buckets of microseconds: bucket n
+    counts times under 2**n microseconds (and at least half that).
+    """
+    num_buckets = 32
+
+    def __init__(self):
+        self.buckets = [0 for bucket in range(self.num_buckets)]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[min(bucket, self.num_buckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean_us': self.total / self.count * 1e6 if self.count else 0,
+                'max_us': self.max * 1e6,
+                'buckets': {'<%dus' % 2**bucket: count
+                            for bucket, count in enumerate(self.buckets)
+                            if count}}
+
+
+class Stats(object):
+    """Named counters, histograms and gauges, safe to update from any
+    thread. Gauges are functions that are called for their current value
+    when the stats are read.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    def as_dict(self):
+        with self.lock:
+            stats = {'counters': dict(self.counters),
+                     'histograms': {name: histogram.as_dict()
+                                    for name, histogram
+                                    in self.histograms.items()}}
+        stats['gauges'] = {name: gauge()
+                           for name, gauge in list(self.gauges.items())}
+        return stats
+
+
+def dump_periodically(get_stats, file_name, interval=1.0):
+    """Appends ``get_stats()`` to file_name as a line of JSON, with the
+    time, every interval seconds from a background thread.
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            try:
+                stats = get_stats()
+            except ConnectionError:
+                return  # the emulator has gone
+            with open(file_name, 'a') as stats_file:
+                stats_file.write(json.dumps(
+                    {'time': time.time(), 'stats': stats}) + '\n')
+
+    thread = threading.Thread(target=dump)
+    thread.daemon = True
+    thread.start()
+    return thread
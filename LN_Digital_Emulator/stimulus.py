@@ -0,0 +1,161 @@
+"""Scripted input waveforms for the emulator.
+
+A waveform is a list of steps ``(time, pin_num, state)``, time in seconds
+from when it is scheduled. The functions here make the common ones and a
+StimulusScheduler applies them to an emulated LN Digital's inputs:
+
+>>> scheduler = StimulusScheduler(LNd.emulator_connection)
+>>> scheduler.schedule(pulse_train(0, period=0.001, count=100))
+>>> scheduler.schedule(press(1, hold_time=0.5, start=0.2), hardware_addr=1)
+>>> scheduler.wait()
+"""
+import functools
+import heapq
+import itertools
+import threading
+from time import monotonic
+from .clock import REAL_CLOCK
+
+
+def press(pin_num, hold_time, start=0.0):
+    """Turns pin_num on at start and off again hold_time later."""
+    return [(start, pin_num, True), (start + hold_time, pin_num, False)]
+
+
+def pulse_train(pin_num, period, count, duty_cycle=0.5, start=0.0):
+    """count pulses, one every period seconds, each on for duty_cycle of
+    the period.
+    """
+    steps = list()
+    for i in range(count):
+        pulse_start = start + i * period
+        steps.extend(press(pin_num, period * duty_cycle, pulse_start))
+    return steps
+
+
+def bounce(pin_num, state, num_bounces, interval, start=0.0):
+    """pin_num chatters num_bounces times, changing every interval seconds,
+    before settling on state.
+    """
+    steps = list()
+    for i in range(num_bounces):
+        steps.append((start + 2 * i * interval, pin_num, state))
+        steps.append((start + (2 * i + 1) * interval, pin_num, not state))
+    steps.append((start + 2 * num_bounces * interval, pin_num, state))
+    return steps
+
+
+def bouncy_press(pin_num, hold_time, num_bounces, interval, start=0.0):
+    """A press that bounces when it is pressed and when it is released.
+    hold_time is from the end of the first bounce to the start of the
+    second.
+    """
+    release_start = start + 2 * num_bounces * interval + hold_time
+    return (bounce(pin_num, True, num_bounces, interval, start) +
+            bounce(pin_num, False, num_bounces, interval, release_start))
+
+
+class StimulusScheduler(object):
+    """Applies waveforms to an emulator's inputs from its own thread.
+
+    It sleeps until just before a step is due and then spins, so steps are
+    sent within a few microseconds of their time. They go to the emulator
+    as set_in requests, straight to the board's input state.
+
+    On a clock.VirtualClock (the emulator's clock in virtual time) there is
+    no thread, the steps are applied by the clock as it is moved on.
+    """
+    # how long before a step to stop sleeping
+    spin_time = 0.001
+
+    def __init__(self, emulator_connection, clock=REAL_CLOCK):
+        self.emulator_connection = emulator_connection
+        self.clock = clock
+        # heap of (due, order, pin_num, state, hardware_addr)
+        self.steps = list()
+        self.order = itertools.count()
+        self.sending = False
+        self.steps_changed = threading.Condition()
+        # virtual time: steps scheduled before a cancel() are ignored
+        self.generation = 0
+        self.last_due = clock.monotonic()
+        if not clock.virtual:
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def schedule(self, steps, hardware_addr=0, start=None):
+        """Schedules a waveform on a board. start is the monotonic() time
+        (of the clock) its step times are from, now by default.
+        """
+        if start is None:
+            start = self.clock.monotonic()
+        if self.clock.virtual:
+            for time, pin_num, state in steps:
+                self.clock.call_at(start + time, functools.partial(
+                    self.apply_step,
+                    self.generation,
+                    pin_num,
+                    state,
+                    hardware_addr))
+                self.last_due = max(self.last_due, start + time)
+            return
+        with self.steps_changed:
+            for time, pin_num, state in steps:
+                heapq.heappush(self.steps, (start + time,
+                                            next(self.order),
+                                            pin_num,
+                                            state,
+                                            hardware_addr))
+            self.steps_changed.notify_all()
+
+    def cancel(self):
+        """Drops every step that hasn't been applied yet."""
+        with self.steps_changed:
+            self.steps = list()
+            self.generation += 1
+            self.steps_changed.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until every scheduled step has been applied. Returns
+        False if timeout seconds pass first. In virtual time this moves the
+        clock on to the last step.
+        """
+        if self.clock.virtual:
+            self.clock.advance_to(self.last_due)
+            return True
+        with self.steps_changed:
+            if not self.steps_changed.wait_for(
+                    lambda: not self.steps and not self.sending, timeout):
+                return False
+        self.emulator_connection.request(('sync',))
+        return True
+
+    def apply_step(self, generation, pin_num, state, hardware_addr):
+        if generation == self.generation:
+            self.emulator_connection.send(
+                ('set_in', pin_num, state, hardware_addr))
+
+    def run(self):
+        while True:
+            with self.steps_changed:
+                if not self.steps:
+                    self.steps_changed.wait()
+                    continue
+                due = self.steps[0][0]
+                time_left = due - monotonic()
+                if time_left > self.spin_time:
+                    self.steps_changed.wait(time_left - self.spin_time)
+                    continue
+                due, order, pin_num, state, hardware_addr = \
+                    heapq.heappop(self.steps)
+                self.sending = True
+
+            while monotonic() < due:
+                pass
+            self.emulator_connection.send(
+                ('set_in', pin_num, state, hardware_addr))
+
+            with self.steps_changed:
+                self.sending = False
+                self.steps_changed.notify_all()